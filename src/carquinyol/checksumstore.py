@@ -0,0 +1,102 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sqlite3
+
+
+class ChecksumStore(object):
+    """Keep track of the checksums of the files of the entries, to find
+    identical ones.
+
+    Entries whose file got checked without calculating its checksum are
+    recorded with a checksum of None.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(uid TEXT PRIMARY KEY, checksum TEXT)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS entries_checksum '
+            'ON entries (checksum)')
+        self._connection.commit()
+
+    def add(self, uid, checksum):
+        self.add_many([(uid, checksum)])
+
+    def add_many(self, entries):
+        """Record the checksums of a list of (uid, checksum) pairs."""
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO entries (uid, checksum) '
+                'VALUES (?, ?)', entries)
+
+    def remove(self, uid):
+        with self._connection:
+            self._connection.execute('DELETE FROM entries WHERE uid = ?',
+                                     (uid, ))
+
+    def contains(self, uid):
+        cursor = self._connection.execute(
+            'SELECT 1 FROM entries WHERE uid = ?', (uid, ))
+        return cursor.fetchone() is not None
+
+    def get_checksum(self, uid):
+        """Return the checksum of an entry, or None if unknown."""
+        cursor = self._connection.execute(
+            'SELECT checksum FROM entries WHERE uid = ?', (uid, ))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def is_unhashed(self, uid):
+        """Check if an entry got recorded without a checksum."""
+        cursor = self._connection.execute(
+            'SELECT 1 FROM entries WHERE uid = ? AND checksum IS NULL',
+            (uid, ))
+        return cursor.fetchone() is not None
+
+    def get_uids(self, checksum):
+        """Return the entries whose file has the given checksum."""
+        cursor = self._connection.execute(
+            'SELECT uid FROM entries WHERE checksum = ?', (checksum, ))
+        return [row[0] for row in cursor]
+
+    def replace_checksum(self, old_checksum, new_checksum):
+        """Change the checksum of all entries having old_checksum, returning
+        their uids.
+        """
+        uids = self.get_uids(old_checksum)
+        with self._connection:
+            self._connection.execute(
+                'UPDATE entries SET checksum = ? WHERE checksum = ?',
+                (new_checksum, old_checksum))
+        return uids
+
+    def has_legacy_checksums(self):
+        """Check if any checksum is missing the algorithm prefix, i.e. is
+        a md5 one.
+        """
+        cursor = self._connection.execute(
+            "SELECT 1 FROM entries WHERE checksum NOT LIKE '%:%' LIMIT 1")
+        return cursor.fetchone() is not None
+
+    def close(self):
+        self._connection.close()
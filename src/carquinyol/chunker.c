@@ -0,0 +1,127 @@
+#define PY_SSIZE_T_CLEAN
+#include "Python.h"
+
+#include <stdint.h>
+
+// Keep the table, and so the chunk boundaries, the same across versions,
+// or identical data stored before and after a change won't be shared
+#define GEAR_SEED 0x6361727175696e79ULL
+
+static uint64_t gear[256];
+
+static uint64_t
+splitmix64 (uint64_t * state) {
+    uint64_t z = (*state += 0x9e3779b97f4a7c15ULL);
+
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+static void
+init_gear (void) {
+    uint64_t state = GEAR_SEED;
+    int i;
+
+    for (i = 0; i < 256; i++)
+        gear[i] = splitmix64 (&state);
+}
+
+/* Return the length of the chunk starting at data, or 0 if the chunk
+ * doesn't end before data + size.
+ *
+ * A chunk ends after a byte where the top bits of a gear hash of the
+ * preceding bytes are all zero, but is at least min_size and at most
+ * max_size long. Chunks only depend on their own content, so a change in
+ * a file only changes the chunks around it.
+ */
+static Py_ssize_t
+find_cut (const unsigned char *data, Py_ssize_t size, Py_ssize_t min_size,
+        uint64_t mask, Py_ssize_t max_size) {
+    uint64_t hash = 0;
+    Py_ssize_t i;
+
+    if (size > max_size)
+        size = max_size;
+    else if (size < max_size && size <= min_size)
+        return 0;
+
+    for (i = min_size; i < size; i++) {
+        hash = (hash << 1) + gear[data[i]];
+        if (!(hash & mask))
+            return i + 1;
+    }
+
+    return size == max_size ? max_size : 0;
+}
+
+static PyObject *
+chunker_find_cuts (PyObject * unused, PyObject * args) {
+    const unsigned char *data = NULL;
+    Py_ssize_t size;
+    Py_ssize_t min_size;
+    Py_ssize_t max_size;
+    Py_ssize_t length;
+    Py_ssize_t pos = 0;
+    Py_ssize_t *lengths;
+    Py_ssize_t count = 0;
+    Py_ssize_t i;
+    int bits;
+    uint64_t mask;
+    PyObject *list = NULL;
+    PyObject *item;
+
+    if (!PyArg_ParseTuple (args, "s#nin:find_cuts", &data, &size,
+                    &min_size, &bits, &max_size))
+        return NULL;
+
+    if (min_size < 0 || max_size <= min_size || bits < 1 || bits > 63) {
+        PyErr_SetString (PyExc_ValueError, "Invalid chunk size parameters");
+        return NULL;
+    }
+
+    mask = ((UINT64_C (1) << bits) - 1) << (64 - bits);
+
+    lengths = PyMem_Malloc ((size / (min_size + 1) + 1) * sizeof (*lengths));
+    if (lengths == NULL)
+        return PyErr_NoMemory ();
+
+    Py_BEGIN_ALLOW_THREADS
+    while ((length = find_cut (data + pos, size - pos, min_size, mask,
+                            max_size)) > 0) {
+        lengths[count++] = length;
+        pos += length;
+    }
+    Py_END_ALLOW_THREADS
+
+    list = PyList_New (count);
+    if (list == NULL)
+        goto cleanup;
+
+    for (i = 0; i < count; i++) {
+        item = PyInt_FromSsize_t (lengths[i]);
+        if (item == NULL) {
+            Py_CLEAR (list);
+            goto cleanup;
+        }
+        PyList_SET_ITEM (list, i, item);
+    }
+
+  cleanup:
+    PyMem_Free (lengths);
+    return list;
+}
+
+static PyMethodDef chunker_functions[] = {
+    {"find_cuts", chunker_find_cuts, METH_VARARGS,
+            PyDoc_STR
+                ("Return the lengths of the content-defined chunks at the "
+                        "start of a string, leaving out the data after the "
+                        "last boundary")},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC initchunker (void) {
+    init_gear ();
+    Py_InitModule ("chunker", chunker_functions);
+}
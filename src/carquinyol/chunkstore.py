@@ -0,0 +1,245 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Store files as lists of content-defined chunks, so that nearly
+identical files share the storage of their common parts.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+
+from carquinyol import chunker
+from carquinyol import layoutmanager
+
+# Chunks are between 16 KiB and 256 KiB, 64 KiB on average
+_MIN_CHUNK_SIZE = 16 * 1024
+_CHUNK_BITS = 16
+_MAX_CHUNK_SIZE = 256 * 1024
+
+_READ_SIZE = 4 * 1024 * 1024
+
+# Keep in sync with the format of write_manifest()
+_MANIFEST_MAGIC = 'CQC1'
+
+
+def split_file(path):
+    """Yield the content-defined chunks of a file."""
+    f = open(path, 'rb')
+    try:
+        pending = ''
+        while True:
+            data = f.read(_READ_SIZE)
+            pending += data
+            position = 0
+            for length in chunker.find_cuts(pending, _MIN_CHUNK_SIZE,
+                                            _CHUNK_BITS, _MAX_CHUNK_SIZE):
+                yield pending[position:position + length]
+                position += length
+            pending = pending[position:]
+            if not data:
+                break
+        if pending:
+            yield pending
+    finally:
+        f.close()
+
+
+def read_manifest(path):
+    """Return the list of (digest, size) pairs of the chunks of a file."""
+    f = open(path, 'r')
+    try:
+        lines = f.read().split('\n')
+    finally:
+        f.close()
+
+    if lines[0] != _MANIFEST_MAGIC:
+        raise ValueError('Invalid chunk manifest %s' % (path, ))
+    manifest = []
+    for line in lines[1:]:
+        if line:
+            digest, size = line.split(' ')
+            manifest.append((digest, int(size)))
+    return manifest
+
+
+def write_manifest(path, manifest):
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'w')
+    try:
+        f.write(_MANIFEST_MAGIC + '\n')
+        for digest, size in manifest:
+            f.write('%s %d\n' % (digest, size))
+    finally:
+        f.close()
+    os.rename(temp_path, path)
+
+
+class ChunkStore(object):
+    """Keep the chunks of the files of the entries, each one only once,
+    along with the number of manifests referring to it.
+
+    Chunks get written by write_chunks() and read by copy_to() on a worker
+    thread, the other methods are to be called from the main loop. Chunks
+    that are no longer referenced are only removed while no write or read
+    is in progress, as these may be relying on them being present.
+    """
+
+    def __init__(self):
+        layout_manager = layoutmanager.get_instance()
+        self._chunks_dir = layout_manager.get_chunks_dir()
+        self._connection = sqlite3.connect(
+            layout_manager.get_chunks_db_path())
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS chunks '
+            '(digest TEXT PRIMARY KEY, size INTEGER, refs INTEGER)')
+        self._connection.commit()
+        self._writes = 0
+        self._reads = 0
+        self._garbage = set()
+
+    def get_chunk_path(self, digest):
+        return '%s/%s/%s' % (self._chunks_dir, digest[:2], digest)
+
+    def begin_write(self):
+        self._writes += 1
+
+    def end_write(self):
+        self._writes -= 1
+        self._collect_garbage()
+
+    def begin_read(self):
+        self._reads += 1
+
+    def end_read(self):
+        self._reads -= 1
+        self._collect_garbage()
+
+    def write_chunks(self, path):
+        """Split the file at path into chunks and write the ones not stored
+        yet.
+
+        Runs on a worker thread, between calls to begin_write() and
+        end_write(). Returns the manifest of the file, to be passed to
+        add_references().
+        """
+        manifest = []
+        for data in split_file(path):
+            digest = hashlib.sha256(data).hexdigest()
+            chunk_path = self.get_chunk_path(digest)
+            if not os.path.exists(chunk_path):
+                self._write_chunk(chunk_path, data)
+            manifest.append((digest, len(data)))
+        return manifest
+
+    def _write_chunk(self, chunk_path, data):
+        dir_path = os.path.dirname(chunk_path)
+        if not os.path.exists(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                # created by a concurrent write
+                if not os.path.isdir(dir_path):
+                    raise
+
+        fd, temp_path = tempfile.mkstemp(dir=dir_path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temp_path, chunk_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def add_references(self, manifest):
+        """Record that a manifest refers to its chunks."""
+        with self._connection:
+            for digest, size in manifest:
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO chunks (digest, size, refs) '
+                    'VALUES (?, ?, 0)', (digest, size))
+                self._connection.execute(
+                    'UPDATE chunks SET refs = refs + 1 WHERE digest = ?',
+                    (digest, ))
+
+    def release(self, manifest):
+        """Drop the references of a manifest to its chunks, removing the
+        chunks no longer referenced.
+        """
+        with self._connection:
+            for digest, size in manifest:
+                self._connection.execute(
+                    'UPDATE chunks SET refs = refs - 1 WHERE digest = ?',
+                    (digest, ))
+        self._garbage.update([digest for digest, size in manifest])
+        self._collect_garbage()
+
+    def copy_to(self, manifest, fd):
+        """Write the file made of the chunks of a manifest to fd.
+
+        May run on a worker thread, between calls to begin_read() and
+        end_read().
+        """
+        for digest, size in manifest:
+            f = open(self.get_chunk_path(digest), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if len(data) != size:
+                raise IOError('Chunk %s is damaged' % (digest, ))
+            while data:
+                data = data[os.write(fd, data):]
+
+    def get_stats(self):
+        """Return the number of chunks and the bytes they take up."""
+        cursor = self._connection.execute(
+            'SELECT COUNT(*), SUM(size) FROM chunks')
+        count, size = cursor.fetchone()
+        return {'count': count, 'bytes': size or 0}
+
+    def _collect_garbage(self):
+        if self._writes or self._reads or not self._garbage:
+            return
+
+        digests = []
+        for digest in self._garbage:
+            cursor = self._connection.execute(
+                'SELECT 1 FROM chunks WHERE digest = ? AND refs <= 0',
+                (digest, ))
+            if cursor.fetchone() is not None:
+                digests.append(digest)
+        self._garbage.clear()
+
+        for digest in digests:
+            try:
+                os.remove(self.get_chunk_path(digest))
+            except OSError:
+                logging.exception('Cannot remove chunk %s', digest)
+        with self._connection:
+            self._connection.executemany(
+                'DELETE FROM chunks WHERE digest = ?',
+                [(digest, ) for digest in digests])
+
+    def close(self):
+        self._connection.close()
@@ -32,13 +32,18 @@ from gi.repository import GObject
 
 from sugar3 import mime
 
+from carquinyol import indexupdater
 from carquinyol import layoutmanager
 from carquinyol import migration
+from carquinyol.journal import JournalError
 from carquinyol.layoutmanager import MAX_QUERY_LIMIT
+from carquinyol.memoryindex import MemoryIndex
 from carquinyol.metadatastore import MetadataStore
-from carquinyol.indexstore import IndexStore
+from carquinyol.indexstore import COUNT_NONE, IndexStore
+from carquinyol.indexupdater import IndexUpdater
 from carquinyol.filestore import FileStore
 from carquinyol.optimizer import Optimizer
+from carquinyol.statefile import StateFile
 
 # the name used by the logger
 DS_LOG_CHANNEL = 'org.laptop.sugar.DataStore'
@@ -48,6 +53,13 @@ DS_DBUS_INTERFACE = "org.laptop.sugar.DataStore"
 DS_OBJECT_PATH = "/org/laptop/sugar/DataStore"
 MIN_INDEX_FREE_BYTES = 1024 * 1024 * 5
 
+# Matches read per step of find_stream()
+_STREAM_PAGE_SIZE = 50
+# Approximate maximum size of the entries sent in one ResultChunk signal
+_STREAM_CHUNK_BYTES = 512 * 1024
+# Entries found from the index alone checked per idle call
+_CHECK_ENTRIES_BATCH_SIZE = 100
+
 logger = logging.getLogger(DS_LOG_CHANNEL)
 
 
@@ -65,13 +77,31 @@ class DataStore(dbus.service.Object):
         migrated, initiated = self._open_layout()
 
         self._metadata_store = MetadataStore()
-        self._file_store = FileStore()
-        self._optimizer = Optimizer(self._file_store, self._metadata_store)
+        self._file_store = FileStore(chunking=options.get('chunking', False))
         self._index_store = IndexStore()
+        self._optimizer = Optimizer(self._file_store, self._metadata_store,
+                                    self._index_store)
         self._index_updating = False
+        # answers queries while _index_updating
+        self._memory_index = None
+        self._index_updater = None
+        self._verify_index_id = None
+        # entries found from the index alone, see _check_entries_later()
+        self._unchecked_uids = set()
+        self._check_entries_id = None
+        # source ids of the find_stream() queries in progress, by query id
+        self._find_streams = {}
 
         root_path = layoutmanager.get_instance().get_root_path()
-        self._cleanflag = os.path.join(root_path, 'ds_clean')
+        self._state = StateFile(os.path.join(root_path, 'ds_state'))
+        self._index_store.set_epoch(self._state.generation)
+        # marked the data store as clean before the state file existed
+        legacy_clean_flag = os.path.join(root_path, 'ds_clean')
+        clean = self._state.clean
+        if clean is None:
+            clean = os.path.exists(legacy_clean_flag)
+        if os.path.exists(legacy_clean_flag):
+            os.remove(legacy_clean_flag)
 
         if initiated:
             logging.debug('Initiate datastore')
@@ -86,26 +116,34 @@ class DataStore(dbus.service.Object):
             return
 
         rebuild = False
+        recover = False
         stat = os.statvfs(root_path)
         da = stat.f_bavail * stat.f_bsize
 
-        if not self._index_store.index_updated:
-            logging.warn('Index is not up-to-date')
+        if da < MIN_INDEX_FREE_BYTES:
+            logging.warn('Disk space tight for index')
             rebuild = True
-        elif not os.path.exists(self._cleanflag):
-            logging.warn('DS state is not clean')
+        elif self._index_store.rebuild_interrupted():
+            logging.warn('Index rebuild did not finish')
             rebuild = True
-        elif da < MIN_INDEX_FREE_BYTES:
-            logging.warn('Disk space tight for index')
+        elif not clean:
+            logging.warn('DS state is not clean')
+            recover = True
+        elif self._index_store.get_epoch() != self._state.generation:
+            logging.warn('Index is not up-to-date')
+            recover = True
+
+        if recover and not self._recover_index():
             rebuild = True
 
         if rebuild:
             logging.warn('Trigger index rebuild')
             self._rebuild_index()
-        else:
+        elif not recover:
             # fast path
             try:
                 self._index_store.open_index()
+                self._verify_index()
             except:
                 logging.exception('Failed to open index')
                 # try...
@@ -115,18 +153,14 @@ class DataStore(dbus.service.Object):
         return
 
     def _mark_clean(self):
-        try:
-            f = open(self._cleanflag, 'w')
-            os.fsync(f.fileno())
-            f.close()
-        except:
-            logging.exception("Could not mark the datastore clean")
+        if self._index_updating:
+            # done by _update_index_finished_cb()
+            return
+        self._state.mark_clean()
 
     def _mark_dirty(self):
-        try:
-            os.remove(self._cleanflag)
-        except:
-            pass
+        self._state.mark_dirty()
+        self._index_store.set_epoch(self._state.generation)
 
     def _open_layout(self):
         """Open layout manager, check version of data store on disk and
@@ -149,9 +183,46 @@ class DataStore(dbus.service.Object):
         if old_version == 0:
             migration.migrate_from_0()
 
+        if old_version < 7:
+            migration.migrate_from_6()
+
         layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
         return True, False
 
+    def _recover_index(self):
+        """Re-index the entries changed after the last index flush, then
+        verify the index in the background.
+
+        Only the first record of the journal is sure to have survived a
+        crash, so if there is any, all entries get re-indexed while
+        verifying. Returns False if recovering isn't possible and the index
+        needs to be rebuilt.
+        """
+        try:
+            uids = self._index_store.get_uncommitted()
+        except JournalError:
+            logging.exception('Cannot replay index journal')
+            return False
+
+        logging.warn('Re-indexing %d changed entries', len(uids))
+        try:
+            self._index_store.open_index()
+            for uid in uids:
+                entry_path = layoutmanager.get_instance().get_entry_path(uid)
+                if os.path.exists(entry_path):
+                    # deletes the entry if it got only partially written
+                    self._index_entry(uid)
+                if not os.path.exists(entry_path):
+                    self._index_store.delete(uid)
+            self._index_store.flush()
+        except Exception:
+            logging.exception('Failed to recover index')
+            self._index_store.close_index()
+            return False
+
+        self._verify_index(reindex=bool(uids))
+        return True
+
     def _rebuild_index(self):
         """Remove and recreate index."""
         self._index_store.close_index()
@@ -198,67 +269,85 @@ class DataStore(dbus.service.Object):
     def _update_index(self):
         """Find entries that are not yet in the index and add them."""
         uids = layoutmanager.get_instance().find_all()
-        logging.debug('Going to update the index with object_ids %r',
-                      uids)
+        # also cancels marking the data store clean if pending
+        self._mark_dirty()
         self._index_updating = True
-        GObject.idle_add(lambda: self.__update_index_cb(uids),
-                         priority=GObject.PRIORITY_LOW)
+        self._memory_index = MemoryIndex()
+        self._index_updater = IndexUpdater(
+            self._index_store, self._metadata_store, self._file_store,
+            self._memory_index.store, self.IndexProgress,
+            self._update_index_finished_cb)
+        self._index_updater.start(uids)
+
+    def _update_index_finished_cb(self):
+        self._index_updating = False
+        self._memory_index = None
+        self._index_updater = None
+        self._mark_clean()
 
-    def __update_index_cb(self, uids):
-        if uids:
-            uid = uids.pop()
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="uu")
+    def IndexProgress(self, done, total):
+        pass
 
-            logging.debug('Updating entry %r in index. %d to go.', uid,
-                          len(uids))
+    def _index_entry(self, uid):
+        """Add an entry to the index, deleting it if it is corrupt."""
+        try:
+            props = self._metadata_store.retrieve(uid)
+            if indexupdater.complete_properties(uid, props):
+                self._metadata_store.store(uid, props)
+            self._index_store.store(uid, props)
+        except Exception:
+            logging.exception('Error processing %r', uid)
+            indexupdater.delete_corrupt_entry(uid, self._file_store)
+
+    def _verify_index(self, reindex=False):
+        """Check in the background that the index matches the entries on
+        disk, fixing up any difference.
+
+        If reindex is set, all entries get indexed again, also fixing up
+        the index documents of entries changed since they got indexed.
+        """
+        if self._verify_index_id is not None or self._index_updating:
+            return
 
-            if not self._index_store.contains(uid):
-                try:
-                    update_metadata = False
-                    props = self._metadata_store.retrieve(uid)
-                    if 'filesize' not in props:
-                        path = self._file_store.get_file_path(uid)
-                        if os.path.exists(path):
-                            props['filesize'] = os.stat(path).st_size
-                            update_metadata = True
-                    if 'timestamp' not in props:
-                        props['timestamp'] = str(int(time.time()))
-                        update_metadata = True
-                    if 'creation_time' not in props:
-                        if 'ctime' in props:
-                            try:
-                                props['creation_time'] = time.mktime(
-                                    time.strptime(
-                                        props['ctime'],
-                                        migration.DATE_FORMAT))
-                            except (TypeError, ValueError):
-                                pass
-                        if 'creation_time' not in props:
-                            props['creation_time'] = props['timestamp']
-                        update_metadata = True
-                    if update_metadata:
-                        self._metadata_store.store(uid, props)
-                    self._index_store.store(uid, props)
-                except Exception:
-                    logging.exception('Error processing %r', uid)
-                    logging.warn('Will attempt to delete corrupt entry %r',
-                                 uid)
-                    try:
-                        # self.delete(uid) only works on well-formed
-                        # entries :-/
-                        entry_path = \
-                            layoutmanager.get_instance().get_entry_path(uid)
-                        shutil.rmtree(entry_path)
-                    except Exception:
-                        logging.exception('Error deleting corrupt entry %r',
-                                          uid)
-
-        if not uids:
-            self._index_store.flush()
-            self._index_updating = False
-            logging.debug('Finished updating index.')
-            return False
-        else:
-            return True
+        logging.debug('Verifying index')
+        steps = self._verify_index_steps(reindex)
+        self._verify_index_id = GObject.idle_add(
+            lambda: self.__verify_index_cb(steps),
+            priority=GObject.PRIORITY_LOW)
+
+    def __verify_index_cb(self, steps):
+        if not self._index_updating:
+            try:
+                steps.next()
+                return True
+            except StopIteration:
+                logging.debug('Finished verifying index')
+
+        self._verify_index_id = None
+        return False
+
+    def _verify_index_steps(self, reindex):
+        index_uids = set(self._index_store.get_uids())
+        yield
+
+        for uids in layoutmanager.get_instance().iter_uids():
+            for uid in uids:
+                if reindex:
+                    index_uids.discard(uid)
+                    self._index_entry(uid)
+                elif uid in index_uids:
+                    index_uids.remove(uid)
+                elif not self._index_store.contains(uid):
+                    logging.warning('Adding missing entry %r to index', uid)
+                    self._index_entry(uid)
+            yield
+
+        layout_manager = layoutmanager.get_instance()
+        for uid in index_uids:
+            if not os.path.exists(layout_manager.get_entry_path(uid)):
+                logging.warning('Removing stale entry %r from index', uid)
+                self._index_store.delete(uid)
 
     def _create_completion_cb(self, async_cb, async_err_cb, uid, exc=None):
         logger.debug('_create_completion_cb(%r, %r, %r, %r)', async_cb,
@@ -267,9 +356,6 @@ class DataStore(dbus.service.Object):
             async_err_cb(exc)
             return
 
-        self.Created(uid)
-        self._optimizer.optimize(uid)
-        logger.debug('created %s', uid)
         self._mark_clean()
         async_cb(uid)
 
@@ -280,10 +366,56 @@ class DataStore(dbus.service.Object):
                          byte_arrays=True)
     def create(self, props, file_path, transfer_ownership,
                async_cb, async_err_cb):
+        self._mark_dirty()
+        self._create(props, file_path, transfer_ownership,
+                     lambda uid, exc: self._create_completion_cb(
+                         async_cb, async_err_cb, uid, exc))
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a(a{sv}sb)',
+                         out_signature='a(ss)',
+                         async_callbacks=('async_cb', 'async_err_cb'),
+                         byte_arrays=True)
+    def create_many(self, entries, async_cb, async_err_cb):
+        """Create several entries from (props, file_path,
+        transfer_ownership) tuples, committing the index once.
+
+        Returns a (uid, error) pair for each entry, error being empty on
+        success and uid empty if the entry couldn't be created at all.
+        """
+        logging.debug('datastore.create_many %d entries', len(entries))
+        if not entries:
+            async_cb([])
+            return
+
+        self._mark_dirty()
+        batch = _Batch(len(entries), self._batch_completion_cb, async_cb)
+        self._index_store.begin_batch()
+        try:
+            for i, (props, file_path, transfer_ownership) in \
+                    enumerate(entries):
+                try:
+                    self._create(props, file_path, transfer_ownership,
+                                 lambda uid, exc, i=i: batch.set_result(
+                                     i, (uid, _format_error(exc)), exc))
+                except Exception, e:
+                    logging.exception('Error creating entry')
+                    batch.set_result(i, ('', _format_error(e)), e)
+        finally:
+            self._index_store.end_batch()
+
+    def _create(self, props, file_path, transfer_ownership, completion_cb):
+        """Add an entry, calling completion_cb(uid, exc) once its file got
+        stored.
+        """
+        if file_path and not os.path.isfile(file_path):
+            # don't leave an entry behind
+            raise ValueError('No file at %r' % file_path)
+
         uid = str(uuid.uuid4())
         logging.debug('datastore.create %r', uid)
 
-        self._mark_dirty()
+        self._index_store.begin_change(uid)
 
         if not props.get('timestamp', ''):
             props['timestamp'] = int(time.time())
@@ -307,11 +439,26 @@ class DataStore(dbus.service.Object):
 
         self._metadata_store.store(uid, props)
         self._index_store.store(uid, props)
+        if self._index_updating:
+            self._index_updater.entry_changed(uid)
+            self._memory_index.store(uid, props)
         self._file_store.store(
             uid, file_path, transfer_ownership,
-            lambda * args: self._create_completion_cb(async_cb,
-                                                      async_err_cb,
-                                                      uid, * args))
+            lambda exc=None: self._entry_created_cb(uid, completion_cb, exc),
+            lambda written, size: self.Progress(uid, written, size))
+
+    def _entry_created_cb(self, uid, completion_cb, exc=None):
+        if exc is None:
+            self.Created(uid)
+            self._optimizer.optimize(uid)
+            logger.debug('created %s', uid)
+        completion_cb(uid, exc)
+
+    def _batch_completion_cb(self, async_cb, results, failed):
+        # an entry that failed may be inconsistent, leave it to recovery
+        if not failed:
+            self._mark_clean()
+        async_cb(results)
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
     def Created(self, uid):
@@ -324,9 +471,6 @@ class DataStore(dbus.service.Object):
             async_err_cb(exc)
             return
 
-        self.Updated(uid)
-        self._optimizer.optimize(uid)
-        logger.debug('updated %s', uid)
         self._mark_clean()
         async_cb()
 
@@ -337,9 +481,55 @@ class DataStore(dbus.service.Object):
                          byte_arrays=True)
     def update(self, uid, props, file_path, transfer_ownership,
                async_cb, async_err_cb):
-        logging.debug('datastore.update %r', uid)
+        self._mark_dirty()
+        self._update(uid, props, file_path, transfer_ownership,
+                     lambda exc: self._update_completion_cb(
+                         async_cb, async_err_cb, uid, exc))
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a(sa{sv}sb)',
+                         out_signature='as',
+                         async_callbacks=('async_cb', 'async_err_cb'),
+                         byte_arrays=True)
+    def update_many(self, entries, async_cb, async_err_cb):
+        """Update several entries from (uid, props, file_path,
+        transfer_ownership) tuples, committing the index once.
+
+        Returns an error for each entry, empty on success.
+        """
+        logging.debug('datastore.update_many %d entries', len(entries))
+        if not entries:
+            async_cb([])
+            return
 
         self._mark_dirty()
+        batch = _Batch(len(entries), self._batch_completion_cb, async_cb)
+        self._index_store.begin_batch()
+        try:
+            for i, (uid, props, file_path, transfer_ownership) in \
+                    enumerate(entries):
+                try:
+                    self._update(uid, props, file_path, transfer_ownership,
+                                 lambda exc, i=i: batch.set_result(
+                                     i, _format_error(exc), exc))
+                except Exception, e:
+                    logging.exception('Error updating entry %r', uid)
+                    batch.set_result(i, _format_error(e), e)
+        finally:
+            self._index_store.end_batch()
+
+    def _update(self, uid, props, file_path, transfer_ownership,
+                completion_cb):
+        """Update an entry, calling completion_cb(exc) once its file got
+        stored.
+        """
+        logging.debug('datastore.update %r', uid)
+
+        if file_path and not os.path.isfile(file_path):
+            # don't leave the entry changed
+            raise ValueError('No file at %r' % file_path)
+
+        self._index_store.begin_change(uid)
 
         if not props.get('timestamp', ''):
             props['timestamp'] = int(time.time())
@@ -366,109 +556,294 @@ class DataStore(dbus.service.Object):
 
         self._metadata_store.store(uid, props)
         self._index_store.store(uid, props)
+        if self._index_updating:
+            self._index_updater.entry_changed(uid)
+            self._memory_index.store(uid, props)
 
         if os.path.exists(self._file_store.get_file_path(uid)) and \
                 (not file_path or os.path.exists(file_path)):
             self._optimizer.remove(uid)
         self._file_store.store(
             uid, file_path, transfer_ownership,
-            lambda * args: self._update_completion_cb(async_cb,
-                                                      async_err_cb,
-                                                      uid, * args))
+            lambda exc=None: self._entry_updated_cb(uid, completion_cb, exc),
+            lambda written, size: self.Progress(uid, written, size))
+
+    def _entry_updated_cb(self, uid, completion_cb, exc=None):
+        if exc is None:
+            self.Updated(uid)
+            self._optimizer.optimize(uid)
+            logger.debug('updated %s', uid)
+        completion_cb(exc)
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
     def Updated(self, uid):
         pass
 
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="stt")
+    def Progress(self, uid, written, size):
+        """Emitted while the file of an entry being created or updated is
+        copied in chunks, with the number of bytes written so far.
+        """
+        pass
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}as',
                          out_signature='aa{sv}u')
     def find(self, query, properties):
         logging.debug('datastore.find %r', query)
         t = time.time()
+        results, info = self._find(query, properties)
+        logger.debug('find(): %r', time.time() - t)
+        return results, info.get('count', 0)
 
-        if not self._index_updating:
-            try:
-                uids, count = self._index_store.find(query)
-            except Exception:
-                logging.exception('Failed to query index, will rebuild')
-                self._rebuild_index()
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as',
+                         out_signature='aa{sv}a{sv}')
+    def find_page(self, query, properties):
+        """Like find(), but also return a cursor for the next page.
+
+        The cursor is returned in the 'next' item of the second dictionary,
+        next to the 'count' of matches, and is empty on the last page. To
+        get the next page, call find_page() again with the cursor as the
+        'after' item of the same query. Unlike large offsets, continuing
+        after a cursor is as fast on deep pages as on the first one.
+
+        The 'count' query option selects whether the count should be
+        'exact', an 'estimate' (the default) or left out ('none'). The
+        'count_exact' item tells whether the count returned is exact.
+        """
+        logging.debug('datastore.find_page %r', query)
+        return self._find(query, properties)
 
-        if self._index_updating:
-            logging.warning('Index updating, returning all entries')
-            return self._find_all(query, properties)
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as',
+                         out_signature='s')
+    def find_stream(self, query, properties):
+        """Start a query whose results get delivered by ResultChunk
+        signals, returning the id of the query.
 
-        entries = []
-        for uid in uids:
-            entry_path = layoutmanager.get_instance().get_entry_path(uid)
-            if not os.path.exists(entry_path):
-                logging.warning(
-                    'Inconsistency detected, returning all entries')
-                self._rebuild_index()
-                return self._find_all(query, properties)
+        The matches are read one page at a time in the main loop and sent
+        in chunks of bounded size, so large results don't need to be held
+        in memory at once, neither here nor in the client.
+        """
+        logging.debug('datastore.find_stream %r', query)
+        query_id = str(uuid.uuid4())
+        steps = self._find_stream_steps(query_id, dict(query), properties)
+        self._find_streams[query_id] = GObject.idle_add(
+            lambda: self.__find_stream_cb(query_id, steps),
+            priority=GObject.PRIORITY_LOW)
+        return query_id
 
-            metadata = self._metadata_store.retrieve(uid, properties)
-            self._fill_internal_props(metadata, uid, properties)
-            entries.append(metadata)
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='')
+    def cancel_find_stream(self, query_id):
+        source_id = self._find_streams.pop(query_id, None)
+        if source_id is not None:
+            GObject.source_remove(source_id)
 
-        logger.debug('find(): %r', time.time() - t)
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="saa{sv}b")
+    def ResultChunk(self, query_id, entries, done):
+        pass
 
-        return entries, count
+    def __find_stream_cb(self, query_id, steps):
+        try:
+            steps.next()
+            return True
+        except StopIteration:
+            pass
+        except Exception:
+            logging.exception('Error streaming results of query %s',
+                              query_id)
+            self.ResultChunk(query_id, [], True)
+
+        del self._find_streams[query_id]
+        return False
+
+    def _find_stream_steps(self, query_id, query, properties):
+        remaining = query.pop('limit', MAX_QUERY_LIMIT)
+        after = query.pop('after', None)
+        while True:
+            page_query = dict(query)
+            page_query['limit'] = min(remaining, _STREAM_PAGE_SIZE)
+            if after:
+                # the cursor already accounts for the offset
+                page_query.pop('offset', None)
+                page_query['after'] = after
+            page_query['count'] = COUNT_NONE
+            entries, info = self._find(page_query, properties)
+            after = info['next']
+            remaining -= len(entries)
+            done = not after or remaining <= 0
+
+            chunk = []
+            chunk_size = 0
+            for entry in entries:
+                entry_size = _get_entry_size(entry)
+                if chunk and chunk_size + entry_size > _STREAM_CHUNK_BYTES:
+                    self.ResultChunk(query_id, chunk, False)
+                    yield
+                    chunk = []
+                    chunk_size = 0
+                chunk.append(entry)
+                chunk_size += entry_size
+
+            self.ResultChunk(query_id, chunk, done)
+            if done:
+                return
+            yield
+
+    def _query_index(self, query_function, query, *args):
+        """Answer a query from the index, rebuilding the index if it fails.
+
+        The index gets a copy of query, as it consumes the query options.
+        Returns None if the index is being updated, the query then being up
+        to the memory index.
+        """
+        if self._index_updating:
+            return None
+        try:
+            return query_function(dict(query), *args)
+        except ValueError:
+            # a bad cursor, property name or query value, not a broken index
+            raise
+        except Exception:
+            logging.exception('Failed to query index, will rebuild')
+            self._rebuild_index()
 
-    def _find_all(self, query, properties):
-        uids = layoutmanager.get_instance().find_all()
-        count = len(uids)
+        if self._index_updating:
+            return None
+        # the rebuild already finished, e.g. as there are no entries
+        return query_function(dict(query), *args)
+
+    def _find(self, query, properties):
+        result = self._query_index(self._index_store.find_entries, query,
+                                   properties)
+        if result is None:
+            logging.warning('Index updating, searching %d scanned entries',
+                            len(self._memory_index))
+            return self._find_in_memory(query, properties)
+        uids, filesizes, entries, info = result
+
+        # Read the metadata of the matches not covered by the index
+        missing = [i for i, metadata in enumerate(entries) if metadata is None]
+        if len(missing) < len(entries):
+            self._check_entries_later([uid for uid, metadata
+                                       in zip(uids, entries)
+                                       if metadata is not None])
+        if missing:
+            metadatas = self._metadata_store.retrieve_many(
+                [uids[i] for i in missing], properties)
+            for i, metadata in zip(missing, metadatas):
+                entries[i] = metadata
+
+        results = []
+        for uid, filesize, metadata in zip(uids, filesizes, entries):
+            if metadata is None:
+                logging.warning('Inconsistency detected for %r', uid)
+                self._verify_index()
+                continue
+
+            self._fill_internal_props(metadata, uid, properties, filesize)
+            results.append(metadata)
+
+        return results, info
+
+    def _check_entries_later(self, uids):
+        """Check in the idle loop that entries found from the index alone
+        still exist on disk, dropping them from the index if they don't.
+
+        Only the metadata of the entries is looked for, the index being
+        trusted about their files.
+        """
+        self._unchecked_uids.update(uids)
+        if self._check_entries_id is None:
+            self._check_entries_id = GObject.idle_add(
+                self.__check_entries_cb, priority=GObject.PRIORITY_LOW)
 
-        offset = query.get('offset', 0)
-        limit = query.get('limit', MAX_QUERY_LIMIT)
-        uids = uids[offset:offset + limit]
+    def __check_entries_cb(self):
+        if self._index_updating:
+            # the update finds the entries on disk anyway
+            self._unchecked_uids.clear()
+        layout_manager = layoutmanager.get_instance()
+        for __ in range(_CHECK_ENTRIES_BATCH_SIZE):
+            if not self._unchecked_uids:
+                break
+            uid = self._unchecked_uids.pop()
+            if os.path.exists(layout_manager.get_metadata_record_path(uid)):
+                continue
+
+            logging.warning('Inconsistency detected for %r', uid)
+            entry_path = layout_manager.get_entry_path(uid)
+            if os.path.exists(entry_path):
+                # deletes the entry as its metadata is gone
+                self._index_entry(uid)
+            if not os.path.exists(entry_path):
+                self._index_store.delete(uid)
+
+        if self._unchecked_uids:
+            return True
+        self._check_entries_id = None
+        return False
+
+    def _find_in_memory(self, query, properties):
+        uids, info = self._memory_index.find(query)
 
         entries = []
-        for uid in uids:
-            metadata = self._metadata_store.retrieve(uid, properties)
+        metadatas = self._metadata_store.retrieve_many(uids, properties)
+        for uid, metadata in zip(uids, metadatas):
+            if metadata is None:
+                continue
             self._fill_internal_props(metadata, uid, properties)
             entries.append(metadata)
 
-        return entries, count
+        return entries, info
 
-    def _fill_internal_props(self, metadata, uid, names=None):
+    def _fill_internal_props(self, metadata, uid, names=None, filesize=None):
         """Fill in internal / computed properties in metadata
 
         Properties are only set if they appear in names or if names is
-        empty.
+        empty. The file size is taken from filesize if known, e.g. from
+        the index, and from the data file otherwise.
         """
         if not names or 'uid' in names:
             metadata['uid'] = uid
 
         if not names or 'filesize' in names:
-            file_path = self._file_store.get_file_path(uid)
-            if os.path.exists(file_path):
-                stat = os.stat(file_path)
-                metadata['filesize'] = str(stat.st_size)
-            else:
-                metadata['filesize'] = '0'
+            if filesize is not None:
+                metadata['filesize'] = str(filesize)
+                return
+
+            metadata['filesize'] = str(self._file_store.get_size(uid))
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}',
                          out_signature='as')
     def find_ids(self, query):
-        if not self._index_updating:
-            try:
-                return self._index_store.find(query)[0]
-            except Exception:
-                logging.error('Failed to query index, will rebuild')
-                self._rebuild_index()
-        return []
+        result = self._query_index(self._index_store.find, query)
+        if result is None:
+            result = self._memory_index.find(query)
+        return result[0]
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='s',
                          out_signature='s',
-                         sender_keyword='sender')
-    def get_filename(self, uid, sender=None):
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def get_filename(self, uid, async_cb, async_err_cb, sender=None):
         logging.debug('datastore.get_filename %r', uid)
         user_id = dbus.Bus().get_unix_user(sender)
         extension = self._get_extension(uid)
-        return self._file_store.retrieve(uid, user_id, extension)
+        self._file_store.retrieve(
+            uid, user_id, extension,
+            lambda path, exc: self._retrieve_completion_cb(
+                async_cb, async_err_cb, path, exc))
+
+    def _retrieve_completion_cb(self, async_cb, async_err_cb, path, exc):
+        if exc is not None:
+            async_err_cb(exc)
+            return
+        async_cb(path)
 
     def _get_extension(self, uid):
         mime_type = self._metadata_store.get_property(uid, 'mime_type')
@@ -489,25 +864,90 @@ class DataStore(dbus.service.Object):
                          in_signature='sa{sv}',
                          out_signature='as')
     def get_uniquevaluesfor(self, propertyname, query=None):
-        if propertyname != 'activity':
-            raise ValueError('Only ''activity'' is a supported property name')
-        if query:
-            raise ValueError('The query parameter is not supported')
-        if not self._index_updating:
-            return self._index_store.get_activities()
-        else:
-            logging.warning('Index updating, returning an empty list')
-            return []
+        return self._get_facets(query or {}, [propertyname])[propertyname] \
+            .keys()
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as',
+                         out_signature='a{sa{su}}')
+    def get_facets(self, query, properties):
+        """Count the entries matching query for each value of properties.
+
+        Returns a dictionary holding a dictionary of values and counts for
+        each property, e.g. for showing the number of entries per activity
+        and per mime type next to the filters of the Journal. Supported are
+        properties that can be sorted by, except for the title.
+        """
+        logging.debug('datastore.get_facets %r %r', query, properties)
+        return self._get_facets(query, properties)
+
+    def _get_facets(self, query, properties):
+        facets = self._query_index(self._index_store.get_facets, query,
+                                   properties)
+        if facets is None:
+            facets = self._memory_index.get_facets(query, properties)
+        return facets
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def get_stats(self):
+        stats = {}
+        for name, value in self._metadata_store.get_cache_stats().items():
+            stats['metadata_cache_' + name] = value
+        for name, value in self._index_store.get_cache_stats().items():
+            stats['query_cache_' + name] = value
+        for name, value in self._optimizer.get_stats().items():
+            stats['optimizer_' + name] = value
+        for name, value in self._file_store.get_chunk_stats().items():
+            stats['chunks_' + name] = value
+        for name, value in self._file_store.get_ingest_stats().items():
+            stats['ingests_' + name] = value
+        return stats
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='s',
                          out_signature='')
     def delete(self, uid):
         self._mark_dirty()
+        self._delete(uid)
+        self._mark_clean()
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='as',
+                         out_signature='as')
+    def delete_many(self, uids):
+        """Delete several entries, committing the index once.
+
+        Returns an error for each entry, empty on success.
+        """
+        logging.debug('datastore.delete_many %d entries', len(uids))
+        errors = []
+        self._mark_dirty()
+        self._index_store.begin_batch()
+        try:
+            for uid in uids:
+                try:
+                    self._delete(uid)
+                    errors.append('')
+                except Exception, e:
+                    errors.append(_format_error(e))
+        finally:
+            self._index_store.end_batch()
+
+        if not any(errors):
+            self._mark_clean()
+        return errors
+
+    def _delete(self, uid):
+        self._index_store.begin_change(uid)
         try:
             entry_path = layoutmanager.get_instance().get_entry_path(uid)
             self._optimizer.remove(uid)
             self._index_store.delete(uid)
+            if self._index_updating:
+                self._index_updater.entry_changed(uid)
+                self._memory_index.delete(uid)
             self._file_store.delete(uid)
             self._metadata_store.delete(uid)
             # remove the dirtree
@@ -523,7 +963,6 @@ class DataStore(dbus.service.Object):
 
         self.Deleted(uid)
         logger.debug('deleted %s', uid)
-        self._mark_clean()
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
     def Deleted(self, uid):
@@ -532,6 +971,7 @@ class DataStore(dbus.service.Object):
     def stop(self):
         """shutdown the service"""
         self._index_store.close_index()
+        self._state.close()
         self.Stopped()
 
     @dbus.service.signal(DS_DBUS_INTERFACE)
@@ -563,3 +1003,45 @@ class DataStore(dbus.service.Object):
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="a{sv}")
     def Unmounted(self, descriptor):
         pass
+
+
+class _Batch(object):
+    """Collect the results of the entries of a bulk call, which may be
+    known in any order.
+
+    completion_cb(async_cb, results, failed) gets called once all results
+    are known, with failed set if any entry failed. There must be at least
+    one entry.
+    """
+
+    def __init__(self, size, completion_cb, async_cb):
+        self._results = [None] * size
+        self._done = set()
+        self._failed = False
+        self._completion_cb = completion_cb
+        self._async_cb = async_cb
+
+    def set_result(self, i, result, exc=None):
+        if i in self._done:
+            return
+        self._done.add(i)
+        self._results[i] = result
+        if exc is not None:
+            self._failed = True
+        if len(self._done) == len(self._results):
+            self._completion_cb(self._async_cb, self._results, self._failed)
+
+
+def _format_error(exc):
+    if exc is None:
+        return ''
+    return '%s: %s' % (exc.__class__.__name__, exc)
+
+
+def _get_entry_size(entry):
+    size = 0
+    for name, value in entry.items():
+        size += len(name)
+        if isinstance(value, basestring):
+            size += len(value)
+    return size
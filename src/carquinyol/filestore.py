@@ -15,27 +15,74 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import ctypes
+import ctypes.util
 import errno
+import fcntl
+import itertools
 import logging
 import tempfile
+import time
 
 from gi.repository import GObject
 
 from sugar3 import env
 
 from carquinyol import layoutmanager
+from carquinyol.chunkstore import ChunkStore, read_manifest, write_manifest
+from carquinyol.workers import WorkerPool
+
+# Smaller files are always stored whole
+_MIN_CHUNKED_FILE_SIZE = 1024 * 1024
+
+# ioctl request making a file share the blocks of another one, from
+# linux/fs.h
+_FICLONE = 0x40049409
+
+# Maximum number of bytes copied per copy_file_range() or sendfile() call
+_KERNEL_COPY_SIZE = 64 * 1024 * 1024
+
+# Errors meaning that a way of copying isn't supported for the files
+_UNSUPPORTED_ERRNOS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.ENOTTY])
+
+# Number of files being copied or split into chunks at once, overall and
+# per device they are read from
+_MAX_INGESTS = 4
+_MAX_INGESTS_PER_DEVICE = 2
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
 
 
 class FileStore(object):
     """Handle the storage of one file per entry.
+
+    If chunking is enabled, big files are split into chunks shared with
+    the other entries and described by a manifest, instead of getting
+    stored whole. Entries stored that way can be read even after chunking
+    got disabled.
     """
 
     # TODO: add protection against store and retrieve operations on entries
     # that are being processed async.
 
-    def store(self, uid, file_path, transfer_ownership, completion_cb):
+    def __init__(self, chunking=False):
+        self._chunking = chunking
+        # opened on first use, see _get_chunk_store()
+        self._chunk_store = None
+        self._workers = WorkerPool(_MAX_INGESTS, 'filestore')
+        self._ingests = IngestScheduler()
+
+    def store(self, uid, file_path, transfer_ownership, completion_cb,
+              progress_cb=None):
         """Store a file for a given entry.
 
+        progress_cb(written, size) gets called while the file is being
+        copied in the idle loop, see AsyncCopy.
+
         """
         dir_path = layoutmanager.get_instance().get_entry_path(uid)
         if not os.path.exists(dir_path):
@@ -53,21 +100,23 @@ class FileStore(object):
                 # We should not move original file
                 transfer_ownership = False
 
-            if transfer_ownership:
-                try:
-                    logging.debug('FileStore moving from %r to %r', file_path,
-                        destination_path)
-                    os.rename(file_path, destination_path)
-                    completion_cb()
-                except OSError, e:
-                    if e.errno == errno.EXDEV:
-                        self._async_copy(file_path, destination_path,
-                                         completion_cb, unlink_src=True)
-                    else:
-                        raise
+            if self._chunking and \
+                    os.path.getsize(file_path) >= _MIN_CHUNKED_FILE_SIZE:
+                run = lambda completion: self._store_chunks(
+                    uid, file_path, transfer_ownership, completion)
             else:
-                self._async_copy(file_path, destination_path, completion_cb,
-                        unlink_src=False)
+                # moving is quick, so it doesn't need to wait for its turn
+                # unless another file is being stored for the entry
+                if transfer_ownership and \
+                        not self._ingests.has_jobs(uid) and \
+                        self._move(uid, file_path, destination_path):
+                    completion_cb()
+                    return
+                run = lambda completion: self._copy(
+                    uid, file_path, destination_path, transfer_ownership,
+                    completion, progress_cb)
+            self._schedule_ingest(uid, file_path, transfer_ownership, run,
+                                  completion_cb)
             """
         TODO: How can we support deleting the file of an entry?
         elif not file_path and os.path.exists(destination_path):
@@ -79,27 +128,201 @@ class FileStore(object):
             logging.debug('FileStore: Nothing to do')
             completion_cb()
 
+    def _schedule_ingest(self, uid, file_path, transfer_ownership, run,
+                         completion_cb):
+        """Call run(completion) once the IngestScheduler allows to, with
+           completion to be called like completion_cb once the file got
+           stored.
+
+        """
+        def start(done):
+            finished = []
+
+            def completion(exc=None):
+                if finished:
+                    return
+                finished.append(True)
+                done()
+                completion_cb(exc)
+
+            try:
+                run(completion)
+            except Exception, e:
+                logging.exception('Error storing %r', file_path)
+                completion(e)
+
+        def cancel():
+            logging.debug('FileStore not storing %r for deleted entry %r',
+                          file_path, uid)
+            if transfer_ownership:
+                os.unlink(file_path)
+            completion_cb(ValueError('Entry %r got deleted' % (uid, )))
+
+        self._ingests.add(uid, file_path, start, cancel)
+
+    def _move(self, uid, file_path, destination_path):
+        """Move a file into an entry, returning False if it's on another
+           file system.
+
+        """
+        try:
+            logging.debug('FileStore moving from %r to %r', file_path,
+                destination_path)
+            os.rename(file_path, destination_path)
+        except OSError, e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+        # only now that the file took over from the chunks
+        self._remove_manifest(uid)
+        return True
+
+    def _copy(self, uid, file_path, destination_path, transfer_ownership,
+              completion_cb, progress_cb):
+        if transfer_ownership and \
+                self._move(uid, file_path, destination_path):
+            completion_cb()
+            return
+
+        def completion(exc=None):
+            if exc is None:
+                try:
+                    self._remove_manifest(uid)
+                except Exception, e:
+                    logging.exception('Error removing the manifest of %r',
+                                      uid)
+                    exc = e
+            completion_cb(exc)
+
+        self._async_copy(file_path, destination_path, completion,
+                         unlink_src=transfer_ownership,
+                         progress_cb=progress_cb)
+
+    def _store_chunks(self, uid, file_path, transfer_ownership,
+                      completion_cb):
+        """Start splitting a file into chunks on a worker thread, only
+        writing the chunks not stored yet.
+
+        """
+        logging.debug('FileStore splitting %r into chunks', file_path)
+        chunk_store = self._get_chunk_store()
+        chunk_store.begin_write()
+        self._workers.submit(
+            chunk_store.write_chunks, (file_path, ),
+            lambda manifest, exc: self._chunks_written_cb(
+                uid, file_path, transfer_ownership, completion_cb, manifest,
+                exc))
+
+    def _chunks_written_cb(self, uid, file_path, transfer_ownership,
+                           completion_cb, manifest, exc):
+        try:
+            if exc is None:
+                self._set_manifest(uid, manifest)
+                if transfer_ownership:
+                    os.remove(file_path)
+        except Exception, e:
+            logging.exception('Error storing the chunks of %r', uid)
+            exc = e
+        finally:
+            self._chunk_store.end_write()
+        completion_cb(exc)
+
+    def _set_manifest(self, uid, manifest):
+        manifest_path = layoutmanager.get_instance().get_manifest_path(uid)
+        old_manifest = []
+        if os.path.exists(manifest_path):
+            old_manifest = read_manifest(manifest_path)
+
+        # references are added before and dropped after the manifest got
+        # written, so a crash can only leak chunks
+        chunk_store = self._get_chunk_store()
+        chunk_store.add_references(manifest)
+        try:
+            write_manifest(manifest_path, manifest)
+        except:
+            chunk_store.release(manifest)
+            raise
+        chunk_store.release(old_manifest)
+
+        data_path = layoutmanager.get_instance().get_data_path(uid)
+        if os.path.exists(data_path):
+            os.remove(data_path)
+
+    def _remove_manifest(self, uid):
+        manifest_path = layoutmanager.get_instance().get_manifest_path(uid)
+        if not os.path.exists(manifest_path):
+            return
+
+        manifest = read_manifest(manifest_path)
+        os.remove(manifest_path)
+        self._get_chunk_store().release(manifest)
+
+    def _get_chunk_store(self):
+        """Return the chunk store, opening it if needed.
+
+        It only gets opened once a file is to be split into chunks or a
+        manifest is found, so that data stores not using chunks don't pay
+        for it.
+
+        """
+        if self._chunk_store is None:
+            self._chunk_store = ChunkStore()
+        return self._chunk_store
+
     def _async_copy(self, file_path, destination_path, completion_cb,
-            unlink_src):
-        """Start copying a file asynchronously.
+            unlink_src, progress_cb=None):
+        """Start copying a file asynchronously, on a worker thread if the
+           kernel can do the copy, else in the idle loop.
 
         """
         logging.debug('FileStore copying from %r to %r', file_path,
             destination_path)
-        async_copy = AsyncCopy(file_path, destination_path, completion_cb,
-                unlink_src)
-        async_copy.start()
+        self._workers.submit(
+            copy_file, (file_path, destination_path),
+            lambda method, exc: self._copy_cb(
+                file_path, destination_path, completion_cb, unlink_src,
+                progress_cb, method, exc))
+
+    def _copy_cb(self, file_path, destination_path, completion_cb,
+                 unlink_src, progress_cb, method, exc):
+        if exc is None and method is None:
+            logging.debug('FileStore falling back to copying %r in chunks',
+                          file_path)
+            async_copy = AsyncCopy(file_path, destination_path,
+                                   completion_cb, unlink_src, progress_cb)
+            try:
+                async_copy.start()
+                return
+            except (IOError, OSError), e:
+                exc = e
+
+        if exc is not None:
+            logging.error('Error copying %s -> %s: %r', file_path,
+                          destination_path, exc)
+        else:
+            logging.debug('FileStore copied %r using %s', file_path, method)
+        # like AsyncCopy, the source is removed even if the copy failed
+        if unlink_src:
+            os.unlink(file_path)
+        completion_cb(exc)
 
-    def retrieve(self, uid, user_id, extension):
+    def retrieve(self, uid, user_id, extension, completion_cb):
         """Place the file associated to a given entry into a directory
            where the user can read it. The caller is reponsible for
            deleting this file.
 
+           completion_cb(path, exc) gets called with the path of the file,
+           empty if the entry has none, once it is in place. Files stored
+           as chunks are put back together on a worker thread.
+
         """
         file_path = layoutmanager.get_instance().get_data_path(uid)
-        if not os.path.exists(file_path):
+        manifest_path = layoutmanager.get_instance().get_manifest_path(uid)
+        if not os.path.exists(file_path) and \
+                not os.path.exists(manifest_path):
             logging.debug('Entry %r doesnt have any file', uid)
-            return ''
+            completion_cb('', None)
+            return
 
         use_instance_dir = os.path.exists('/etc/olpc-security') and \
                            os.getuid() != user_id
@@ -120,6 +343,19 @@ class FileStore(object):
 
         fd, destination_path = tempfile.mkstemp(prefix=uid + '_',
                 suffix=extension, dir=destination_dir)
+        if not os.path.exists(file_path):
+            # stored as chunks, put them back together
+            try:
+                os.fchmod(fd, 0444)
+                manifest = read_manifest(manifest_path)
+            except:
+                os.close(fd)
+                os.unlink(destination_path)
+                raise
+            self._assemble_chunks(manifest, fd, destination_path,
+                                  completion_cb)
+            return
+
         os.close(fd)
         os.unlink(destination_path)
 
@@ -133,18 +369,68 @@ class FileStore(object):
             else:
                 raise
 
-        return destination_path
+        completion_cb(destination_path, None)
+
+    def _assemble_chunks(self, manifest, fd, destination_path,
+                         completion_cb):
+        """Start writing the chunks of a manifest to fd on a worker thread.
+
+        """
+        def assemble():
+            try:
+                chunk_store.copy_to(manifest, fd)
+            finally:
+                os.close(fd)
+
+        def assembled_cb(result, exc):
+            chunk_store.end_read()
+            if exc is not None:
+                logging.error('Error putting %s together: %r',
+                              destination_path, exc)
+                os.unlink(destination_path)
+                completion_cb(None, exc)
+                return
+            completion_cb(destination_path, None)
+
+        chunk_store = self._get_chunk_store()
+        chunk_store.begin_read()
+        self._workers.submit(assemble, callback=assembled_cb)
 
     def get_file_path(self, uid):
+        """Return the path of the file of an entry, which doesn't exist if
+        it has no file or got stored as chunks.
+
+        """
         return layoutmanager.get_instance().get_data_path(uid)
 
+    def get_size(self, uid):
+        file_path = layoutmanager.get_instance().get_data_path(uid)
+        if os.path.exists(file_path):
+            return os.stat(file_path).st_size
+
+        manifest_path = layoutmanager.get_instance().get_manifest_path(uid)
+        if os.path.exists(manifest_path):
+            return sum([size for __, size in read_manifest(manifest_path)])
+        return 0
+
+    def get_chunk_stats(self):
+        if self._chunk_store is None and not os.path.exists(
+                layoutmanager.get_instance().get_chunks_db_path()):
+            return {'count': 0, 'bytes': 0}
+        return self._get_chunk_store().get_stats()
+
+    def get_ingest_stats(self):
+        return self._ingests.get_stats()
+
     def delete(self, uid):
         """Remove the file associated to a given entry.
 
         """
+        self._ingests.cancel(uid)
         file_path = layoutmanager.get_instance().get_data_path(uid)
         if os.path.exists(file_path):
             os.remove(file_path)
+        self._remove_manifest(uid)
 
     def hard_link_entry(self, new_uid, existing_uid):
         existing_file = layoutmanager.get_instance().get_data_path(
@@ -158,29 +444,222 @@ class FileStore(object):
         os.link(existing_file, new_file)
 
 
+def copy_file(src, dest):
+    """Copy a file by making it share the blocks of the source, or else by
+    letting the kernel copy it with copy_file_range() or sendfile().
+
+    Runs on a worker thread. Returns the name of the way the file got
+    copied, or None if none is supported for these files, leaving an empty
+    file at dest.
+    """
+    if os.path.exists(dest):
+        os.unlink(dest)
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_TRUNC | os.O_CREAT, 0444)
+        try:
+            size = os.fstat(src_fd).st_size
+            for method in [_reflink, _copy_file_range, _sendfile]:
+                try:
+                    method(src_fd, dest_fd, size)
+                    return method.__name__.lstrip('_')
+                except (IOError, OSError), e:
+                    if e.errno not in _UNSUPPORTED_ERRNOS:
+                        raise
+                # start again from scratch with the next way
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+                os.ftruncate(dest_fd, 0)
+            return None
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _reflink(src_fd, dest_fd, size):
+    fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dest_fd, size):
+    function = _get_libc_function('copy_file_range', [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint])
+    _copy_in_kernel(lambda count: function(src_fd, None, dest_fd, None,
+                                           count, 0), size)
+
+
+def _sendfile(src_fd, dest_fd, size):
+    function = _get_libc_function('sendfile', [
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    _copy_in_kernel(lambda count: function(dest_fd, src_fd, None, count),
+                    size)
+
+
+def _copy_in_kernel(copy, size):
+    """Call copy(count) until size bytes got copied or the end of the source
+    is reached, with copy returning the number of bytes copied like
+    copy_file_range() and sendfile().
+    """
+    copied = 0
+    while copied < size:
+        count = copy(min(_KERNEL_COPY_SIZE, size - copied))
+        if count < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+        if count == 0:
+            break
+        copied += count
+
+
+def _get_libc_function(name, argtypes):
+    """Return a libc function returning a ssize_t, raising an OSError
+    with ENOSYS if it isn't available.
+    """
+    function = getattr(_libc, name, None)
+    if function is None:
+        raise OSError(errno.ENOSYS, '%s() is not available' % (name, ))
+    function.argtypes = argtypes
+    function.restype = ctypes.c_ssize_t
+    return function
+
+
+class IngestScheduler(object):
+    """Run the jobs storing files a few at a time.
+
+    Pending jobs get started smallest file first, with a limit on the jobs
+    reading from the same device, so that big files don't hold up small
+    ones and concurrent copies don't starve the main loop. Jobs for the
+    same entry run one after the other, in the order they were added.
+    """
+
+    def __init__(self, max_jobs=_MAX_INGESTS,
+                 max_jobs_per_device=_MAX_INGESTS_PER_DEVICE):
+        self._max_jobs = max_jobs
+        self._max_jobs_per_device = max_jobs_per_device
+        self._counter = itertools.count()
+        # (size, sequence number, device, uid, start, cancel) tuples, in
+        # the order they were added
+        self._pending = []
+        self._running_uids = set()
+        self._running_devices = {}
+
+    def add(self, uid, path, start, cancel):
+        """Add a job storing the file at path for an entry.
+
+        start(done) gets called once the job may run, and done() must be
+        called once it finished. If the entry gets deleted before, cancel()
+        gets called instead.
+        """
+        stat = os.stat(path)
+        self._pending.append((stat.st_size, self._counter.next(),
+                              stat.st_dev, uid, start, cancel))
+        self._start_jobs()
+
+    def has_jobs(self, uid):
+        if uid in self._running_uids:
+            return True
+        for job in self._pending:
+            if job[3] == uid:
+                return True
+        return False
+
+    def cancel(self, uid):
+        """Drop the pending jobs of an entry."""
+        jobs = [job for job in self._pending if job[3] == uid]
+        for job in jobs:
+            self._pending.remove(job)
+        for job in jobs:
+            job[5]()
+
+    def get_stats(self):
+        return {'pending': len(self._pending),
+                'running': len(self._running_uids)}
+
+    def _start_jobs(self):
+        while len(self._running_uids) < self._max_jobs:
+            job = self._next_job()
+            if job is None:
+                return
+
+            self._pending.remove(job)
+            __, __, device, uid, start, __ = job
+            self._running_uids.add(uid)
+            self._running_devices[device] = \
+                self._running_devices.get(device, 0) + 1
+            start(lambda: self._job_done(uid, device))
+
+    def _next_job(self):
+        blocked_uids = set(self._running_uids)
+        next_job = None
+        for job in self._pending:
+            size, __, device, uid, __, __ = job
+            if uid in blocked_uids:
+                continue
+            # later jobs of the entry have to wait for this one
+            blocked_uids.add(uid)
+            if self._running_devices.get(device, 0) >= \
+                    self._max_jobs_per_device:
+                continue
+            if next_job is None or size < next_job[0]:
+                next_job = job
+        return next_job
+
+    def _job_done(self, uid, device):
+        self._running_uids.discard(uid)
+        self._running_devices[device] -= 1
+        if not self._running_devices[device]:
+            del self._running_devices[device]
+        self._start_jobs()
+
+
 class AsyncCopy(object):
     """Copy a file in chunks in the idle loop.
 
+    The chunk size adapts so that each iteration takes about TIME_BUDGET
+    seconds, getting smaller while the main loop is slow to call back.
+    progress, if given, is called with the number of bytes written and
+    the size of the file, at most every PROGRESS_INTERVAL seconds and once
+    the copy is complete.
+
     """
     CHUNK_SIZE = 65536
-
-    def __init__(self, src, dest, completion, unlink_src=False):
+    MIN_CHUNK_SIZE = 65536
+    MAX_CHUNK_SIZE = 16 * 1024 * 1024
+    TIME_BUDGET = 0.02
+    # Delay between two iterations above which the main loop is considered
+    # busy
+    MAX_LATENCY = 0.1
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, src, dest, completion, unlink_src=False,
+                 progress=None):
         self.src = src
         self.dest = dest
         self.completion = completion
         self._unlink_src = unlink_src
+        self._progress = progress
         self.src_fp = -1
         self.dest_fp = -1
         self.written = 0
         self.size = 0
+        self.chunk_size = AsyncCopy.CHUNK_SIZE
+        self._last_block_end = 0
+        self._last_progress = 0
 
     def _cleanup(self):
         os.close(self.src_fp)
         os.close(self.dest_fp)
 
     def _copy_block(self, user_data=None):
+        start = time.time()
+        latency = start - self._last_block_end
+        chunk_size = self.chunk_size
         try:
-            data = os.read(self.src_fp, AsyncCopy.CHUNK_SIZE)
+            data = os.read(self.src_fp, chunk_size)
             count = os.write(self.dest_fp, data)
             self.written += len(data)
 
@@ -192,10 +671,9 @@ class AsyncCopy(object):
                         'Error writing data to destination file'))
                 return False
 
-            # FIXME: emit progress here
-
             # done?
-            if len(data) < AsyncCopy.CHUNK_SIZE:
+            if len(data) < chunk_size:
+                self._report_progress(force=True)
                 self._complete(None)
                 return False
         except Exception, err:
@@ -204,8 +682,28 @@ class AsyncCopy(object):
             self._complete(err)
             return False
 
+        self._last_block_end = time.time()
+        self._adapt_chunk_size(self._last_block_end - start, latency)
+        self._report_progress()
         return True
 
+    def _adapt_chunk_size(self, duration, latency):
+        if duration > AsyncCopy.TIME_BUDGET or \
+                latency > AsyncCopy.MAX_LATENCY:
+            self.chunk_size = max(self.chunk_size / 2,
+                                  AsyncCopy.MIN_CHUNK_SIZE)
+        elif duration < AsyncCopy.TIME_BUDGET / 2:
+            self.chunk_size = min(self.chunk_size * 2,
+                                  AsyncCopy.MAX_CHUNK_SIZE)
+
+    def _report_progress(self, force=False):
+        if self._progress is None:
+            return
+        now = time.time()
+        if force or now - self._last_progress >= AsyncCopy.PROGRESS_INTERVAL:
+            self._last_progress = now
+            self._progress(self.written, self.size)
+
     def _complete(self, *args):
         self._cleanup()
         if self._unlink_src:
@@ -223,4 +721,6 @@ class AsyncCopy(object):
         stat = os.fstat(self.src_fp)
         self.size = stat[6]
 
-        GObject.idle_add(self._copy_block)
+        self._last_block_end = time.time()
+        # let D-Bus calls be handled first
+        GObject.idle_add(self._copy_block, priority=GObject.PRIORITY_LOW)
@@ -14,6 +14,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import base64
+import json
+import locale
 import logging
 import os
 import sys
@@ -23,7 +26,11 @@ import xapian
 from xapian import WritableDatabase, Document, Enquire, Query
 
 from carquinyol import layoutmanager
+from carquinyol import metadatareader
+from carquinyol.journal import ChangeJournal, JournalError
+from carquinyol import metadatastore
 from carquinyol.layoutmanager import MAX_QUERY_LIMIT
+from carquinyol.lrucache import LRUCache
 
 _VALUE_UID = 0
 _VALUE_TIMESTAMP = 1
@@ -31,6 +38,9 @@ _VALUE_TITLE = 2
 # 3 reserved for version support
 _VALUE_FILESIZE = 4
 _VALUE_CREATION_TIME = 5
+_VALUE_MIME_TYPE = 6
+_VALUE_ACTIVITY = 7
+_VALUE_KEEP = 8
 
 _PREFIX_NONE = 'N'
 _PREFIX_FULL_VALUE = 'F'
@@ -43,9 +53,32 @@ _PREFIX_KEEP = 'K'
 # Force a flush every _n_ changes to the db
 _FLUSH_THRESHOLD = 20
 
-# Force a flush after _n_ seconds since the last change to the db
+# Force a flush at most _n_ seconds after the first unflushed change to the db
 _FLUSH_TIMEOUT = 5
 
+# While rebuilding, commit in big batches
+_REBUILD_FLUSH_THRESHOLD = 1000
+
+_OPERATION_CHANGE = 'C'
+_OPERATION_STORE = 'S'
+_OPERATION_DELETE = 'D'
+_OPERATION_REBUILD = 'R'
+
+# Kinds of cursors returned for continuing a query, see encode_cursor()
+CURSOR_KEYS = 'k'
+CURSOR_OFFSET = 'o'
+
+# Values of the 'count' query option. Exact counts need all matches to be
+# looked at, estimates are based on the ones needed for the page and no
+# count saves even checking whether there is another page.
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATE = 'estimate'
+COUNT_NONE = 'none'
+
+# Number of parsed queries and of query results to keep
+_QUERY_CACHE_SIZE = 100
+_RESULT_CACHE_SIZE = 20
+
 _PROPERTIES_NOT_TO_INDEX = ['timestamp', 'preview', 'launch-times']
 
 _MAX_RESULTS = int(2 ** 31 - 1)
@@ -58,6 +91,31 @@ _QUERY_TERM_MAP = {
     'keep': _PREFIX_KEEP,
 }
 
+# Properties kept in the document data, so that find() can return them
+# without reading the metadata of each match. Chosen to cover the list view
+# of the Journal; big values like previews must not be added.
+_PROJECTED_PROPERTIES = frozenset([
+    'uid', 'title', 'timestamp', 'creation_time', 'mtime', 'filesize',
+    'mime_type', 'activity', 'activity_id', 'bundle_id', 'keep',
+    'icon-color', 'buddies', 'progress', 'title_set_by_user',
+])
+
+# Type of values sorted according to the collation rules of the locale
+_COLLATED = 'collated'
+
+# Properties stored in value slots, which find() can sort by. Changing this
+# requires the index to be rebuilt, i.e. a bump of CURRENT_LAYOUT_VERSION.
+_SORT_VALUE_MAP = {
+    'uid': {'number': _VALUE_UID, 'type': str},
+    'timestamp': {'number': _VALUE_TIMESTAMP, 'type': float},
+    'title': {'number': _VALUE_TITLE, 'type': _COLLATED},
+    'filesize': {'number': _VALUE_FILESIZE, 'type': int},
+    'creation_time': {'number': _VALUE_CREATION_TIME, 'type': float},
+    'mime_type': {'number': _VALUE_MIME_TYPE, 'type': str},
+    'activity': {'number': _VALUE_ACTIVITY, 'type': str},
+    'keep': {'number': _VALUE_KEEP, 'type': int},
+}
+
 _QUERY_VALUE_MAP = {
     'timestamp': {'number': _VALUE_TIMESTAMP, 'type': float},
     'filesize': {'number': _VALUE_FILESIZE, 'type': int},
@@ -68,24 +126,22 @@ _QUERY_VALUE_MAP = {
 class TermGenerator (xapian.TermGenerator):
 
     def index_document(self, document, properties):
-        document.add_value(_VALUE_TIMESTAMP,
-            xapian.sortable_serialise(float(properties['timestamp'])))
-        document.add_value(_VALUE_TITLE, properties.get('title', '').strip())
-        if 'filesize' in properties:
-            try:
-                document.add_value(_VALUE_FILESIZE,
-                    xapian.sortable_serialise(int(properties['filesize'])))
-            except (ValueError, TypeError):
-                logging.debug('Invalid value for filesize property: %s',
-                              properties['filesize'])
-        if 'creation_time' in properties:
+        for name, info in _SORT_VALUE_MAP.items():
+            # the uid is set by build_document()
+            if name == 'uid' or name not in properties:
+                continue
             try:
-                document.add_value(
-                    _VALUE_CREATION_TIME, xapian.sortable_serialise(
-                        float(properties['creation_time'])))
+                document.add_value(info['number'], _serialise_value(
+                    info['type'], properties[name]))
             except (ValueError, TypeError):
-                logging.debug('Invalid value for creation_time property: %s',
-                              properties['creation_time'])
+                logging.debug('Invalid value for %s property: %s', name,
+                              properties[name])
+
+        projection = {}
+        for name in _PROJECTED_PROPERTIES:
+            if name in properties:
+                projection[name] = properties[name]
+        document.set_data(metadatastore.encode_record(projection))
 
         self.set_document(document)
 
@@ -227,17 +283,191 @@ class QueryParser (xapian.QueryParser):
         return Query(Query.OP_AND, queries)
 
 
+def build_document(uid, properties):
+    """Create the index document of an entry.
+
+    Doesn't need the database, so it can be called from any thread.
+    """
+    document = Document()
+    document.add_value(_VALUE_UID, uid)
+    term_generator = TermGenerator()
+    term_generator.index_document(document, properties)
+    return document
+
+
+class CollationError(Exception):
+    pass
+
+
+def get_collation_key(text):
+    """Return a string that sorts like text according to the collation
+    rules of the current locale, ignoring case.
+    """
+    if not isinstance(text, unicode):
+        text = str(text).decode('utf-8', 'replace')
+    text = text.strip().lower().encode('utf-8')
+    try:
+        return locale.strxfrm(text)
+    except locale.Error:
+        return text
+
+
+def _serialise_value(value_type, value):
+    if value_type is float or value_type is int:
+        return xapian.sortable_serialise(value_type(value))
+    elif value_type == _COLLATED:
+        return get_collation_key(value)
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _unserialise_value(value_type, value):
+    if value_type is float or value_type is int:
+        return str(value_type(xapian.sortable_unserialise(value)))
+    return value
+
+
+def _get_sort_keys(order_by):
+    """Return the list of (value number, reverse) tuples to sort by.
+
+    The uid is added as a last key, so that each match has a distinct
+    position to continue from. Returns an empty list if no property of
+    order_by can be sorted by.
+    """
+    keys = []
+    for name in order_by:
+        info = _SORT_VALUE_MAP.get(name[1:])
+        if name[:1] not in ['+', '-'] or info is None:
+            logging.warning('Unsupported property for sorting: %s', name)
+            continue
+        keys.append((info['number'], name[0] == '+'))
+
+    if keys and keys[-1][0] != _VALUE_UID:
+        keys.append((_VALUE_UID, keys[0][1]))
+    return keys
+
+
+def encode_cursor(kind, order_by, values):
+    """Return an opaque token for continuing a query after a page.
+
+    kind is CURSOR_KEYS, with values holding the sort keys of the last
+    match, or CURSOR_OFFSET, with values holding the offset of the next
+    match.
+    """
+    data = [kind, order_by] + [base64.b64encode(value) for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data))
+
+
+def decode_cursor(token):
+    """Return the (kind, order_by, values) encoded in a cursor token."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(token)))
+        kind, order_by = [str(item) for item in data[:2]]
+        values = [base64.b64decode(value) for value in data[2:]]
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor %r' % (token, ))
+    return kind, order_by, values
+
+
+def _has_value_query(number):
+    # empty values aren't stored, any other one sorts after '\0'
+    return Query(Query.OP_VALUE_GE, number, '\0')
+
+
+def _value_equal_query(number, value):
+    if not value:
+        return Query(Query.OP_AND_NOT, Query(''), _has_value_query(number))
+    return Query(Query.OP_VALUE_RANGE, number, value, value)
+
+
+def _value_greater_query(number, value):
+    if not value:
+        return _has_value_query(number)
+    return Query(Query.OP_AND_NOT, Query(Query.OP_VALUE_GE, number, value),
+                 Query(Query.OP_VALUE_RANGE, number, value, value))
+
+
+def _value_less_query(number, value):
+    if not value:
+        return None
+    return Query(Query.OP_AND_NOT, Query(''),
+                 Query(Query.OP_VALUE_GE, number, value))
+
+
+def _after_query(keys, values):
+    """Build a query matching the documents that sort after the given
+    values of keys, a list of (value number, reverse) tuples.
+    """
+    alternatives = []
+    equal_queries = []
+    for (number, reverse), value in zip(keys, values):
+        if reverse:
+            after_query = _value_less_query(number, value)
+        else:
+            after_query = _value_greater_query(number, value)
+        if after_query is not None:
+            alternatives.append(Query(Query.OP_AND,
+                                      equal_queries + [after_query]))
+        equal_queries.append(_value_equal_query(number, value))
+
+    if not alternatives:
+        return Query()
+    return Query(Query.OP_OR, alternatives)
+
+
+def _canonicalize(value):
+    """Turn a query dictionary into a hashable value, equal for equal
+    queries.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted([(name, _canonicalize(item))
+                                      for name, item in value.items()])))
+    elif isinstance(value, list):
+        return ('list', tuple([_canonicalize(item) for item in value]))
+    elif isinstance(value, tuple):
+        return ('tuple', tuple([_canonicalize(item) for item in value]))
+    # True, 1 and 1.0 are equal but may not give the same query
+    return (type(value).__name__, value)
+
+
 class IndexStore(object):
     """Index metadata and provide rich query facilities on it.
     """
 
-    def __init__(self):
+    def __init__(self, flush_threshold=_FLUSH_THRESHOLD,
+                 flush_timeout=_FLUSH_TIMEOUT,
+                 result_cache_size=_RESULT_CACHE_SIZE):
         self._database = None
+        # Created once per opened database, see _get_query_parser() and
+        # _get_enquire()
+        self._query_parser = None
+        self._enquire = None
+        self._query_cache = LRUCache(_QUERY_CACHE_SIZE)
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
+        self._key_makers = {}
+        # Results of recent queries, dropped on any change to the database.
+        # A size of 0 disables it.
+        self._result_cache = LRUCache(result_cache_size)
         self._flush_timeout = None
+        self._flush_threshold = flush_threshold
+        self._flush_timeout_seconds = flush_timeout
         self._pending_writes = 0
+        # nesting level of begin_batch() calls
+        self._batch_depth = 0
         root_path=layoutmanager.get_instance().get_root_path()
+        # used to mark the index as up-to-date before epochs got stored
         self._index_updated_path = os.path.join(root_path,
                                                 'index_updated')
+        # stored in the index on each flush, see get_epoch()
+        self._epoch = 0
+        # uids changed since the last flush, to replay them after a crash
+        self._journal = ChangeJournal(os.path.join(root_path,
+                                                   'index_journal'),
+                                      sync=True)
+        self._journaled_uids = set()
+        self._rebuilding = False
         self._std_index_path = layoutmanager.get_instance().get_index_path()
 	self._index_path = self._std_index_path
 
@@ -247,14 +477,14 @@ class IndexStore(object):
         # IO errors such as ENOSPC and retry putting
         # the index on a temp_path
         if temp_path:
-            try:
-                # mark the on-disk index stale
-                self._set_index_updated(False)
-            except:
-                pass
+            # the on-disk index will be stale as its epoch won't get
+            # updated anymore
             self._index_path = temp_path
         else:
              self._index_path = self._std_index_path
+             if os.path.exists(self._index_updated_path):
+                 os.remove(self._index_updated_path)
+        self._reset_caches()
         try:
              self._database = WritableDatabase(self._index_path,
                                                xapian.DB_CREATE_OR_OPEN)
@@ -262,12 +492,30 @@ class IndexStore(object):
              logging.error('Exception opening database')
              raise
 
+        self._check_collation()
+
+    def _check_collation(self):
+        """Make sure the sort keys of titles follow the current locale."""
+        collation = locale.setlocale(locale.LC_COLLATE)
+        index_collation = self._database.get_metadata('collation')
+        if index_collation == collation:
+            return
+
+        if self._database.get_doccount():
+            self._database = None
+            raise CollationError('Index sorted for locale %r, not %r' %
+                                 (index_collation, collation))
+
+        self._database.set_metadata('collation', collation)
+        self._database.flush()
+
     def close_index(self):
         """Close index database if it is open."""
         if not self._database:
             return
 
         self._flush(True)
+        self._reset_caches()
         try:
             # does Xapian write in its destructors?
             self._database = None
@@ -276,6 +524,12 @@ class IndexStore(object):
             raise
 
     def remove_index(self):
+        # Until rebuild_finished() gets called, recovering from the journal
+        # isn't possible
+        self._truncate_journal()
+        self._journal.append(_OPERATION_REBUILD, '')
+        self._rebuilding = True
+
         if not os.path.exists(self._index_path):
             return
         for f in os.listdir(self._index_path):
@@ -291,100 +545,357 @@ class IndexStore(object):
         return True
 
     def store(self, uid, properties):
-        document = Document()
-        document.add_value(_VALUE_UID, uid)
-        term_generator = TermGenerator()
-        term_generator.index_document(document, properties)
-
+        self.store_document(uid, build_document(uid, properties))
+
+    def store_document(self, uid, document):
+        """Add or replace the document of an entry, as returned by
+        build_document().
+        """
+        self._journal_change(_OPERATION_STORE, uid)
+        self._result_cache.clear()
         if not self.contains(uid):
             self._database.add_document(document)
         else:
             self._database.replace_document(_PREFIX_FULL_VALUE + \
                 _PREFIX_UID + uid, document)
 
-        self._flush(True)
+        self._flush()
 
     def find(self, query):
+        query_result, info = self._query(query)
+
+        uids = []
+        for hit in query_result:
+            uids.append(hit.document.get_value(_VALUE_UID))
+
+        return (uids, info.get('count', 0))
+
+    def find_entries(self, query, properties):
+        """Like find(), but also return what the index knows about each
+        match.
+
+        Returns the uids, the file sizes and the requested properties of the
+        matches plus a dictionary holding the 'count' of matches, whether
+        the count is exact ('count_exact') and the cursor for the 'next'
+        page. A file size is None if it isn't indexed. The properties of a
+        match are None if some of them aren't kept in the index. The cursor
+        is empty on the last page and the count is left out if the 'count'
+        query option is COUNT_NONE.
+        """
+        query_result, info = self._query(query)
+        projected = bool(properties) and \
+            _PROJECTED_PROPERTIES.issuperset(properties)
+
+        uids = []
+        filesizes = []
+        entries = []
+        for hit in query_result:
+            document = hit.document
+            uids.append(document.get_value(_VALUE_UID))
+
+            filesize = document.get_value(_VALUE_FILESIZE)
+            if filesize:
+                filesizes.append(int(xapian.sortable_unserialise(filesize)))
+            else:
+                filesizes.append(None)
+
+            data = document.get_data()
+            if projected and data:
+                entries.append(metadatareader.parse(data, properties))
+            else:
+                entries.append(None)
+
+        return (uids, filesizes, entries, info)
+
+    def _query(self, query):
         offset = query.pop('offset', 0)
         limit = query.pop('limit', MAX_QUERY_LIMIT)
         order_by = query.pop('order_by', [])
         query_string = query.pop('query', None)
+        after = query.pop('after', None)
+        count = query.pop('count', COUNT_ESTIMATE)
+        if count not in [COUNT_EXACT, COUNT_ESTIMATE, COUNT_NONE]:
+            raise ValueError('Invalid count option %r' % (count, ))
 
-        query_parser = QueryParser()
-        query_parser.set_database(self._database)
-        enquire = Enquire(self._database)
-        enquire.set_query(query_parser.parse_query(query, query_string))
+        if not order_by:
+            order_by = ['+timestamp']
+        elif isinstance(order_by, basestring):
+            order_by = [order_by]
+        order_by = ','.join(order_by)
+
+        query_key = (_canonicalize(query), query_string)
+        result_key = (query_key, order_by, offset, limit, after, count)
+        result = self._result_cache.get(result_key)
+        if result is not None:
+            return result
+
+        keys = _get_sort_keys(order_by.split(','))
+
+        parsed_query = self._parse_query(query_key, query, query_string)
+        page_query = parsed_query
+        if after:
+            kind, cursor_order_by, values = decode_cursor(after)
+            if cursor_order_by != order_by:
+                raise ValueError('Cursor is for sorting by %s, not %s' %
+                                 (cursor_order_by, order_by))
+            if kind == CURSOR_KEYS and keys and len(values) == len(keys):
+                page_query = Query(Query.OP_AND, parsed_query,
+                                   _after_query(keys, values))
+            elif kind == CURSOR_OFFSET and len(values) == 1:
+                offset += int(values[0])
+            else:
+                raise ValueError('Invalid cursor %r' % (after, ))
 
-        # This will assure that the results count is exact.
-        check_at_least = offset + limit + 1
+        enquire = self._get_enquire()
+        enquire.set_query(page_query)
 
-        if not order_by:
-            order_by = '+timestamp'
+        if count == COUNT_NONE:
+            check_at_least = 0
+        elif count == COUNT_EXACT and page_query is parsed_query:
+            check_at_least = self._database.get_doccount()
         else:
-            order_by = order_by[0]
-
-        if order_by == '+timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, True)
-        elif order_by == '-timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, False)
-        elif order_by == '+title':
-            enquire.set_sort_by_value(_VALUE_TITLE, True)
-        elif order_by == '-title':
-            enquire.set_sort_by_value(_VALUE_TITLE, False)
-        elif order_by == '+filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, True)
-        elif order_by == '-filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, False)
-        elif order_by == '+creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, True)
-        elif order_by == '-creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, False)
+            # Enough to know whether there is another page
+            check_at_least = offset + limit + 1
+
+        if keys:
+            enquire.set_sort_by_key(self._get_key_maker(keys), False)
         else:
-            logging.warning('Unsupported property for sorting: %s', order_by)
+            # the Enquire object is reused, drop the order of the last query
+            enquire.set_sort_by_relevance()
 
         query_result = enquire.get_mset(offset, limit, check_at_least)
-        total_count = query_result.get_matches_estimated()
 
-        uids = []
-        for hit in query_result:
-            uids.append(hit.document.get_value(_VALUE_UID))
-
-        return (uids, total_count)
+        size = query_result.size()
+        end = offset + size
+        if count == COUNT_NONE:
+            # without checking further matches, a full page may be the last
+            has_next = size == limit
+        else:
+            has_next = query_result.get_matches_lower_bound() > end
+
+        info = {'next': ''}
+        if size and has_next:
+            if keys:
+                document = query_result.get_hit(size - 1).document
+                values = [document.get_value(number) for number, __ in keys]
+                info['next'] = encode_cursor(CURSOR_KEYS, order_by, values)
+            else:
+                info['next'] = encode_cursor(CURSOR_OFFSET, order_by,
+                                             [str(end)])
+
+        if count != COUNT_NONE:
+            count_result = query_result
+            if page_query is not parsed_query:
+                # count all matches, not only the ones after the cursor
+                enquire.set_query(parsed_query)
+                if count == COUNT_EXACT:
+                    check_at_least = self._database.get_doccount()
+                else:
+                    check_at_least = 0
+                count_result = enquire.get_mset(0, 0, check_at_least)
+            info['count'] = count_result.get_matches_estimated()
+            info['count_exact'] = count_result.get_matches_lower_bound() == \
+                count_result.get_matches_upper_bound()
+
+        result = (query_result, info)
+        self._result_cache.set(result_key, result)
+        return result
+
+    def _get_key_maker(self, keys):
+        keys = tuple(keys)
+        if keys not in self._key_makers:
+            key_maker = xapian.MultiValueKeyMaker()
+            for number, reverse in keys:
+                key_maker.add_value(number, reverse)
+            # Enquire doesn't keep a reference to it
+            self._key_makers[keys] = key_maker
+        return self._key_makers[keys]
+
+    def _get_enquire(self):
+        if self._enquire is None:
+            self._enquire = Enquire(self._database)
+        return self._enquire
+
+    def _get_query_parser(self):
+        if self._query_parser is None:
+            self._query_parser = QueryParser()
+            self._query_parser.set_database(self._database)
+        return self._query_parser
+
+    def _parse_query(self, query_key, query, query_string):
+        parsed_query = self._query_cache.get(query_key)
+        if parsed_query is not None:
+            self._query_cache_hits += 1
+            return parsed_query
+
+        self._query_cache_misses += 1
+        parsed_query = self._get_query_parser().parse_query(query,
+                                                            query_string)
+        # Wildcards get expanded to the terms in the database at parse time,
+        # so such queries would miss entries added later on
+        if not query_string or '*' not in query_string:
+            self._query_cache.set(query_key, parsed_query)
+        return parsed_query
+
+    def _reset_caches(self):
+        self._query_parser = None
+        self._enquire = None
+        self._query_cache.clear()
+        self._result_cache.clear()
+
+    def get_cache_stats(self):
+        """Return the counters of the parsed query cache."""
+        return {'hits': self._query_cache_hits,
+                'misses': self._query_cache_misses,
+                'entries': len(self._query_cache)}
 
     def delete(self, uid):
+        self._journal_change(_OPERATION_DELETE, uid)
+        self._result_cache.clear()
         self._database.delete_document(_PREFIX_FULL_VALUE + _PREFIX_UID + uid)
-        self._flush(True)
+        self._flush()
 
-    def get_activities(self):
-        activities = []
-        prefix = _PREFIX_FULL_VALUE + _PREFIX_ACTIVITY
+    def get_uids(self):
+        uids = []
+        prefix = _PREFIX_FULL_VALUE + _PREFIX_UID
         for term in self._database.allterms(prefix):
-            activities.append(term.term[len(prefix):])
-        return activities
+            uids.append(term.term[len(prefix):])
+        return uids
+
+    def get_facets(self, query, properties):
+        """Count the matches of query for each value of properties.
+
+        Returns a dictionary mapping each property name to a dictionary of
+        values and their number of matches. Only properties with a value
+        slot that can be read back are supported.
+        """
+        query = dict(query)
+        for name in ['offset', 'limit', 'order_by', 'after', 'count']:
+            query.pop(name, None)
+        query_string = query.pop('query', None)
+
+        spies = {}
+        for name in properties:
+            info = _SORT_VALUE_MAP.get(name)
+            if info is None or info['type'] == _COLLATED:
+                raise ValueError('Cannot count values of property %r' %
+                                 (name, ))
+            spies[name] = xapian.ValueCountMatchSpy(info['number'])
+
+        query_key = (_canonicalize(query), query_string)
+        enquire = self._get_enquire()
+        enquire.set_query(self._parse_query(query_key, query, query_string))
+        for spy in spies.values():
+            enquire.add_matchspy(spy)
+        try:
+            # the spies only see the matches Xapian looks at, i.e. all of
+            # them when asked to check at least as many as there are
+            enquire.get_mset(0, 0, self._database.get_doccount())
+        finally:
+            enquire.clear_matchspies()
+
+        facets = {}
+        for name, spy in spies.items():
+            value_type = _SORT_VALUE_MAP[name]['type']
+            values = {}
+            for item in spy.values():
+                value = _unserialise_value(value_type, item.term)
+                values[value] = item.termfreq
+            facets[name] = values
+        return facets
 
     def flush(self):
         self._flush(True)
 
-    def get_index_updated(self):
-        return os.path.exists(self._index_updated_path)
-
-    index_updated = property(get_index_updated)
-
-    def _set_index_updated(self, index_updated):
-        if self._std_index_path != self._index_path:
-             # operating from tmpfs
-             return True
-        if index_updated != self.index_updated:
-            if index_updated:
-                index_updated_file = open(self._index_updated_path, 'w')
-                # index_updated = True will happen every
-                # indexstore._FLUSH_TIMEOUT seconds, so it is ok to fsync
-                os.fsync(index_updated_file.fileno())
-                index_updated_file.close()
-            else:
-                os.remove(self._index_updated_path)
+    def begin_batch(self):
+        """Defer flushing the index until the matching end_batch(), so that
+        a batch of changes gets committed at once.
+        """
+        self._batch_depth += 1
+
+    def end_batch(self):
+        self._batch_depth -= 1
+        if not self._batch_depth and self._pending_writes:
+            self._flush(True)
+
+    def rebuild_finished(self):
+        """Flush the index once all entries have been added after
+        remove_index().
+        """
+        self._rebuilding = False
+        self._flush(True)
+
+    def begin_change(self, uid):
+        """Record that an entry is about to change.
+
+        Must be called before touching the metadata of the entry, so that
+        it gets re-indexed if the change is interrupted.
+        """
+        self._journal_change(_OPERATION_CHANGE, uid)
+
+    def get_uncommitted(self):
+        """Return the uids changed after the last flush of the index.
+
+        Raises journal.JournalError if the list can't be trusted.
+        """
+        uids = []
+        for operation, uid in self._journal.read():
+            if operation == _OPERATION_REBUILD:
+                raise JournalError('Index rebuild did not finish')
+            if uid not in uids:
+                uids.append(uid)
+        return uids
+
+    def rebuild_interrupted(self):
+        """Return whether the journal tells that a rebuild of the index
+        didn't finish, or can't be read to tell.
+        """
+        try:
+            records = self._journal.read()
+        except JournalError:
+            logging.exception('Cannot read the index journal')
+            return True
+        return (_OPERATION_REBUILD, '') in records
+
+    def _journal_change(self, operation, uid):
+        if self._rebuilding or uid in self._journaled_uids:
+            # the rebuild record already covers all entries
+            return
+        self._journal.append(operation, uid)
+        self._journaled_uids.add(uid)
+
+    def _truncate_journal(self):
+        self._journal.truncate()
+        self._journaled_uids.clear()
+
+    def set_epoch(self, epoch):
+        """Set the epoch to store in the index along with the next flush."""
+        self._epoch = epoch
+
+    def get_epoch(self):
+        """Return the epoch the index on disk got last flushed with, or
+        None if unknown.
+
+        As the epoch gets committed along with the changes, the index is
+        up-to-date if its epoch is the current one.
+        """
+        try:
+            database = xapian.Database(self._std_index_path)
+            epoch = database.get_metadata('epoch')
+        except xapian.Error, e:
+            logging.warning('Cannot read the epoch of the index: %r', e)
+            return None
+
+        if not epoch:
+            # flushed by an older version, which marked the index as
+            # up-to-date with a file instead
+            if os.path.exists(self._index_updated_path):
+                return 0
+            return None
+        return int(epoch)
 
     def _flush_timeout_cb(self):
+        self._flush_timeout = None
         self._flush(True)
         return False
 
@@ -393,16 +904,25 @@ class IndexStore(object):
         logging.debug('IndexStore.flush: force=%r _pending_writes=%r',
                 force, self._pending_writes)
 
-        self._set_index_updated(False)
+        if self._batch_depth:
+            # flushed by end_batch()
+            self._pending_writes += 1
+            return
 
-        if self._flush_timeout is not None:
-            GObject.source_remove(self._flush_timeout)
-            self._flush_timeout = None
+        if self._rebuilding:
+            flush_threshold = _REBUILD_FLUSH_THRESHOLD
+        else:
+            flush_threshold = self._flush_threshold
 
         self._pending_writes += 1
-        if force or self._pending_writes > _FLUSH_THRESHOLD:
+        if force or self._pending_writes > flush_threshold:
+            if self._flush_timeout is not None:
+                GObject.source_remove(self._flush_timeout)
+                self._flush_timeout = None
+
             try:
                 logging.debug("Start database flush")
+                self._database.set_metadata('epoch', str(self._epoch))
                 self._database.flush()
                 logging.debug("Completed database flush")
             except Exception, e:
@@ -411,7 +931,10 @@ class IndexStore(object):
                 # bail out to trigger a reindex
                 sys.exit(1)
             self._pending_writes = 0
-            self._set_index_updated(True)
-        else:
-            self._flush_timeout = GObject.timeout_add_seconds(_FLUSH_TIMEOUT,
-                                                      self._flush_timeout_cb)
+            if not self._rebuilding:
+                self._truncate_journal()
+        elif self._flush_timeout is None:
+            # Keep the first timeout so that a steady stream of changes
+            # can't delay the flush indefinitely
+            self._flush_timeout = GObject.timeout_add_seconds(
+                self._flush_timeout_seconds, self._flush_timeout_cb)
@@ -0,0 +1,253 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Add all entries of the data store to a freshly created index.
+"""
+
+import collections
+import logging
+import os
+import shutil
+import time
+
+from gi.repository import GObject
+
+from carquinyol import indexstore
+from carquinyol import layoutmanager
+from carquinyol import metadatareader
+from carquinyol import migration
+from carquinyol.workers import WorkerPool
+
+# Number of threads reading metadata and building index documents
+_WORKERS = 2
+
+# Number of entries handed to a worker at once
+_CHUNK_SIZE = 200
+
+# Chunks being read or waiting to be written, to bound memory usage
+_MAX_PENDING_CHUNKS = 2 * _WORKERS
+
+# Seconds the writer may block the main loop per iteration
+_WRITE_TIME_BUDGET = 0.05
+
+# Minimum number of seconds between progress reports
+_PROGRESS_INTERVAL = 1
+
+
+def complete_properties(uid, props):
+    """Fill in the properties required by the index that old entries may
+    lack.
+
+    Returns True if props got changed and should be stored again.
+    """
+    update_metadata = False
+    if 'filesize' not in props:
+        path = layoutmanager.get_instance().get_data_path(uid)
+        if os.path.exists(path):
+            props['filesize'] = os.stat(path).st_size
+            update_metadata = True
+    if 'timestamp' not in props:
+        props['timestamp'] = str(int(time.time()))
+        update_metadata = True
+    if 'creation_time' not in props:
+        if 'ctime' in props:
+            try:
+                props['creation_time'] = time.mktime(
+                    time.strptime(props['ctime'], migration.DATE_FORMAT))
+            except (TypeError, ValueError):
+                pass
+        if 'creation_time' not in props:
+            props['creation_time'] = props['timestamp']
+        update_metadata = True
+    return update_metadata
+
+
+def delete_corrupt_entry(uid, file_store):
+    logging.warn('Will attempt to delete corrupt entry %r', uid)
+    try:
+        # drops the references of the entry to its chunks, if any
+        file_store.delete(uid)
+    except Exception:
+        logging.exception('Error deleting the file of corrupt entry %r', uid)
+    try:
+        # DataStore.delete(uid) only works on well-formed entries :-/
+        entry_path = layoutmanager.get_instance().get_entry_path(uid)
+        shutil.rmtree(entry_path)
+    except Exception:
+        logging.exception('Error deleting corrupt entry %r', uid)
+
+
+def _read_metadata(record_path):
+    try:
+        return metadatareader.retrieve(record_path, None)
+    except Exception:
+        logging.exception('Error reading %r', record_path)
+        return None
+
+
+def _read_chunk(uids):
+    """Read the metadata of the entries and build their index documents.
+
+    Runs on a worker thread. Returns a list of (uid, properties, document,
+    update_metadata) tuples, with properties set to None for corrupt
+    entries.
+    """
+    layout_manager = layoutmanager.get_instance()
+    record_paths = [layout_manager.get_metadata_record_path(uid)
+                    for uid in uids]
+    try:
+        metadatas = metadatareader.retrieve_many(record_paths, None)
+    except Exception:
+        # A single corrupt record fails the whole chunk, find out which
+        metadatas = [_read_metadata(path) for path in record_paths]
+
+    results = []
+    for uid, props in zip(uids, metadatas):
+        if props is None:
+            results.append((uid, None, None, False))
+            continue
+
+        try:
+            update_metadata = complete_properties(uid, props)
+            document = indexstore.build_document(uid, props)
+        except Exception:
+            logging.exception('Error processing %r', uid)
+            results.append((uid, None, None, False))
+            continue
+
+        results.append((uid, props, document, update_metadata))
+
+    return results
+
+
+class IndexUpdater(object):
+    """Add entries to the index in the background.
+
+    Metadata gets read and index documents get built by a pool of worker
+    threads, while the main loop writes them to the index, yielding after
+    each time slice so that D-Bus calls keep being served. scanned_cb is
+    called with the metadata of each entry as soon as it has been read.
+    """
+
+    def __init__(self, index_store, metadata_store, file_store, scanned_cb,
+                 progress_cb, finished_cb):
+        self._index_store = index_store
+        self._metadata_store = metadata_store
+        self._file_store = file_store
+        self._scanned_cb = scanned_cb
+        self._progress_cb = progress_cb
+        self._finished_cb = finished_cb
+        self._workers = None
+        self._changed_uids = set()
+        self._chunks = collections.deque()
+        self._results = collections.deque()
+        self._pending_chunks = 0
+        self._write_id = None
+        self._total = 0
+        self._done = 0
+        self._last_progress = 0
+
+    def start(self, uids):
+        logging.debug('Going to update the index with %d entries', len(uids))
+        self._total = len(uids)
+        for i in range(0, len(uids), _CHUNK_SIZE):
+            self._chunks.append(uids[i:i + _CHUNK_SIZE])
+
+        self._workers = WorkerPool(_WORKERS, 'index-updater')
+        self._submit_chunks()
+        self._check_finished()
+
+    def entry_changed(self, uid):
+        """Skip an entry that got changed or deleted after the update
+        started, as what was read from disk may be outdated.
+        """
+        self._changed_uids.add(uid)
+
+    def _submit_chunks(self):
+        while self._chunks and self._pending_chunks < _MAX_PENDING_CHUNKS:
+            self._pending_chunks += 1
+            self._workers.submit(_read_chunk, (self._chunks.popleft(), ),
+                                 self._chunk_read_cb)
+
+    def _chunk_read_cb(self, results, exc):
+        if exc is not None:
+            # _read_chunk handles errors of single entries, so this is a bug
+            logging.error('Error reading chunk of entries: %r', exc)
+            results = []
+
+        # Let queries use the metadata right away, without waiting for it
+        # to be indexed
+        for uid, props, __, __ in results:
+            if props is not None and uid not in self._changed_uids:
+                self._scanned_cb(uid, props)
+
+        self._results.append(collections.deque(results))
+        if self._write_id is None:
+            self._write_id = GObject.idle_add(self._write_cb,
+                                              priority=GObject.PRIORITY_LOW)
+
+    def _write_cb(self):
+        deadline = time.time() + _WRITE_TIME_BUDGET
+        while self._results and time.time() < deadline:
+            results = self._results[0]
+            while results and time.time() < deadline:
+                self._write_entry(*results.popleft())
+
+            if not results:
+                self._results.popleft()
+                self._pending_chunks -= 1
+                self._submit_chunks()
+
+        self._report_progress()
+
+        if self._results:
+            return True
+
+        self._write_id = None
+        self._check_finished()
+        return False
+
+    def _write_entry(self, uid, props, document, update_metadata):
+        self._done += 1
+        if uid in self._changed_uids:
+            return
+        if props is None:
+            delete_corrupt_entry(uid, self._file_store)
+            return
+
+        try:
+            if update_metadata:
+                self._metadata_store.store(uid, props)
+            self._index_store.store_document(uid, document)
+        except Exception:
+            logging.exception('Error processing %r', uid)
+            delete_corrupt_entry(uid, self._file_store)
+
+    def _report_progress(self, force=False):
+        now = time.time()
+        if force or now - self._last_progress >= _PROGRESS_INTERVAL:
+            self._last_progress = now
+            self._progress_cb(self._done, self._total)
+
+    def _check_finished(self):
+        if self._chunks or self._pending_chunks:
+            return
+
+        self._workers.close()
+        self._index_store.rebuild_finished()
+        self._report_progress(force=True)
+        logging.debug('Finished updating index.')
+        self._finished_cb()
@@ -0,0 +1,199 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import os
+import zlib
+from collections import OrderedDict
+
+# Operations logged by JournaledQueue
+_OPERATION_PUSH = 'P'
+_OPERATION_REMOVE = 'R'
+
+# Rewrite the journal of a queue once it holds that many records and more
+# than twice as many as there are items
+_COMPACT_MIN_RECORDS = 1000
+
+
+class JournalError(Exception):
+    pass
+
+
+class ChangeJournal(object):
+    """Append-only log of operations on entries.
+
+    Each record is a line holding an operation code, a uid and a CRC32 of
+    both, so that a damaged journal can be told apart from a complete one.
+
+    If sync is set, the first record appended after opening, truncating or
+    rewriting the journal gets synced to disk, so that at least the fact
+    that there are records to act on survives a crash, at the cost of a
+    single fsync() per truncation.
+    """
+
+    def __init__(self, path, sync=False):
+        self._path = path
+        self._sync = sync
+        self._needs_sync = sync
+        self._file = None
+
+    def append(self, operation, uid):
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        record = '%s %s' % (operation, uid)
+        self._file.write('%s %08x\n' % (record, _checksum(record)))
+        self._file.flush()
+        if self._needs_sync:
+            os.fsync(self._file.fileno())
+            self._needs_sync = False
+
+    def read(self):
+        """Return the list of (operation, uid) records in the journal.
+
+        A last record cut short by a crash is ignored; any other damage
+        raises JournalError.
+        """
+        if not os.path.exists(self._path):
+            return []
+
+        f = open(self._path, 'r')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        lines = data.split('\n')
+        # the last item is either empty or an incomplete record
+        lines.pop()
+
+        records = []
+        for line in lines:
+            try:
+                operation, uid, checksum = line.split(' ')
+                valid = int(checksum, 16) == \
+                    _checksum('%s %s' % (operation, uid))
+            except ValueError:
+                valid = False
+            if not valid:
+                raise JournalError('Corrupt journal record %r in %s' %
+                                   (line, self._path))
+            records.append((operation, uid))
+
+        return records
+
+    def rewrite(self, records):
+        """Replace the content of the journal with a list of (operation,
+        uid) records.
+        """
+        self.close()
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        try:
+            for operation, uid in records:
+                record = '%s %s' % (operation, uid)
+                f.write('%s %08x\n' % (record, _checksum(record)))
+        finally:
+            f.close()
+        os.rename(temp_path, self._path)
+        self._needs_sync = self._sync
+
+    def truncate(self):
+        self.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._needs_sync = self._sync
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class JournaledQueue(object):
+    """First in, first out queue of uids that persists across restarts.
+
+    The queue is kept in memory, with its changes logged to a
+    ChangeJournal. Pushing a uid that is already queued doesn't change its
+    position.
+    """
+
+    def __init__(self, path):
+        self._journal = ChangeJournal(path)
+        self._items = OrderedDict()
+
+        try:
+            records = self._journal.read()
+        except JournalError:
+            logging.exception('Discarding damaged queue %s', path)
+            records = []
+
+        for operation, uid in records:
+            if operation == _OPERATION_PUSH:
+                self._items[uid] = None
+            else:
+                self._items.pop(uid, None)
+        self._records = len(records)
+        self._compact_if_needed()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, uid):
+        return uid in self._items
+
+    def push(self, uid):
+        if uid in self._items:
+            return
+        self._items[uid] = None
+        self._append(_OPERATION_PUSH, uid)
+
+    def peek(self, count):
+        """Return the first count uids, without removing them."""
+        uids = []
+        for uid in self._items:
+            if len(uids) == count:
+                break
+            uids.append(uid)
+        return uids
+
+    def remove(self, uid):
+        if uid not in self._items:
+            return
+        del self._items[uid]
+        if not self._items:
+            self._journal.truncate()
+            self._records = 0
+        else:
+            self._append(_OPERATION_REMOVE, uid)
+
+    def _append(self, operation, uid):
+        self._journal.append(operation, uid)
+        self._records += 1
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        if self._records > _COMPACT_MIN_RECORDS and \
+                self._records > 2 * len(self._items):
+            self._journal.rewrite([(_OPERATION_PUSH, uid)
+                                   for uid in self._items])
+            self._records = len(self._items)
+
+    def close(self):
+        self._journal.close()
+
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
@@ -20,7 +20,7 @@ import logging
 from sugar3 import env
 
 MAX_QUERY_LIMIT = 40960
-CURRENT_LAYOUT_VERSION = 6
+CURRENT_LAYOUT_VERSION = 8
 
 
 class LayoutManager(object):
@@ -34,13 +34,6 @@ class LayoutManager(object):
         if not os.path.exists(self._root_path):
             os.makedirs(self._root_path)
 
-        self._create_if_needed(self.get_checksums_dir())
-        self._create_if_needed(self.get_queue_path())
-
-    def _create_if_needed(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
-
     def get_version(self):
         version_path = os.path.join(self._root_path, 'version')
         version = 0
@@ -65,8 +58,17 @@ class LayoutManager(object):
         return '%s/%s/%s/data' % (self._root_path, uid[:2], uid)
 
     def get_metadata_path(self, uid):
+        """Return the per-property metadata directory used up to layout
+        version 6. Only used for migrating old entries.
+        """
         return '%s/%s/%s/metadata' % (self._root_path, uid[:2], uid)
 
+    def get_metadata_record_path(self, uid):
+        return '%s/%s/%s/metadata.rec' % (self._root_path, uid[:2], uid)
+
+    def get_manifest_path(self, uid):
+        return '%s/%s/%s/manifest' % (self._root_path, uid[:2], uid)
+
     def get_root_path(self):
         return self._root_path
 
@@ -74,19 +76,40 @@ class LayoutManager(object):
         return os.path.join(self._root_path, 'index')
 
     def get_checksums_dir(self):
+        """Return the directory the optimizer used to keep its checksums
+        and queue in. Only used for migrating them.
+        """
         return os.path.join(self._root_path, 'checksums')
 
     def get_queue_path(self):
         return os.path.join(self.get_checksums_dir(), 'queue')
 
+    def get_checksums_db_path(self):
+        return os.path.join(self._root_path, 'checksums.db')
+
+    def get_optimizer_queue_path(self):
+        return os.path.join(self._root_path, 'optimizer_queue')
+
+    def get_chunks_dir(self):
+        return os.path.join(self._root_path, 'chunks')
+
+    def get_chunks_db_path(self):
+        return os.path.join(self._root_path, 'chunks.db')
+
     def find_all(self):
         uids = []
+        for dir_uids in self.iter_uids():
+            uids.extend(dir_uids)
+        return uids
+
+    def iter_uids(self):
+        """Iterate over the entries, yielding one list of uids per
+        directory.
+        """
         for f in os.listdir(self._root_path):
             if os.path.isdir(os.path.join(self._root_path, f)) and len(f) == 2:
-                for g in os.listdir(os.path.join(self._root_path, f)):
-                    if len(g) == 36:
-                        uids.append(g)
-        return uids
+                yield [g for g in os.listdir(os.path.join(self._root_path, f))
+                       if len(g) == 36]
 
     def is_empty(self):
         """Check if there is any existing entry.
@@ -0,0 +1,75 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Mapping that drops the least recently used items once it holds more
+    than max_entries items or their sizes add up to more than max_bytes.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used."""
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            return default
+
+        self._items[key] = (value, size)
+        return value
+
+    def set(self, key, value, size=0):
+        """Add or replace the value for key, accounting size bytes for it."""
+        self.remove(key)
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+
+        self._items[key] = (value, size)
+        self._bytes += size
+
+        while len(self._items) > self._max_entries or \
+                (self._max_bytes is not None and
+                 self._bytes > self._max_bytes):
+            __, (__, old_size) = self._items.popitem(last=False)
+            self._bytes -= old_size
+
+    def remove(self, key):
+        try:
+            __, size = self._items.pop(key)
+        except KeyError:
+            return
+        self._bytes -= size
+
+    def clear(self):
+        self._items.clear()
+        self._bytes = 0
+
+    def get_size(self):
+        """Return the sum of the sizes of all cached values."""
+        return self._bytes
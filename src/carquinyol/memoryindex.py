@@ -0,0 +1,274 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Answer queries from metadata held in memory while the index is being
+rebuilt.
+"""
+
+import logging
+import re
+import sys
+
+from carquinyol.indexstore import COUNT_NONE, CURSOR_KEYS, CURSOR_OFFSET
+from carquinyol.indexstore import decode_cursor, encode_cursor
+from carquinyol.indexstore import get_collation_key
+from carquinyol.layoutmanager import MAX_QUERY_LIMIT
+
+# Properties matched exactly, like the ones with a term prefix in the index
+_TERM_PROPERTIES = ['uid', 'activity', 'activity_id', 'mime_type', 'keep']
+
+# Properties matched by value or range, with the type to compare them as
+_VALUE_PROPERTIES = {
+    'timestamp': float,
+    'filesize': int,
+    'creation_time': float,
+}
+
+_SORT_PROPERTIES = {
+    'uid': str,
+    'timestamp': float,
+    'title': get_collation_key,
+    'filesize': int,
+    'creation_time': float,
+    'mime_type': str,
+    'activity': str,
+    'keep': int,
+}
+
+# Properties searched by free text queries
+_TEXT_PROPERTIES = ['title', 'description', 'tags']
+
+# Bigger values (e.g. previews) are not kept in memory
+_MAX_VALUE_SIZE = 4096
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_QUERY_WORD_RE = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+
+class MemoryIndex(object):
+    """Minimal stand-in for IndexStore, searching a list of entries.
+
+    Supports the same query dictionaries as IndexStore, but free text
+    queries only match whole words (or prefixes, with a trailing *).
+    Cursors returned by IndexStore are accepted as long as the entry they
+    point to has been scanned.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def store(self, uid, properties):
+        entry = {}
+        for name, value in properties.items():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif not isinstance(value, basestring):
+                value = str(value)
+            if len(value) <= _MAX_VALUE_SIZE:
+                entry[name] = value
+        entry['uid'] = uid
+        self._entries[uid] = entry
+
+    def delete(self, uid):
+        self._entries.pop(uid, None)
+
+    def find(self, query):
+        query = dict(query)
+        offset = query.pop('offset', 0)
+        limit = query.pop('limit', MAX_QUERY_LIMIT)
+        order_by = query.pop('order_by', [])
+        query_string = query.pop('query', None)
+        after = query.pop('after', None)
+        count = query.pop('count', None)
+
+        matches = self._match(query, query_string)
+
+        if not order_by:
+            order_by = ['+timestamp']
+        elif isinstance(order_by, basestring):
+            order_by = [order_by]
+        sort_keys = []
+        for name in order_by:
+            if name[:1] in ['+', '-'] and name[1:] in _SORT_PROPERTIES:
+                sort_keys.append((name[1:], name[0] == '+'))
+            else:
+                logging.warning('Unsupported property for sorting: %s', name)
+        if sort_keys:
+            # ties are broken by uid, in the same direction as IndexStore
+            matches.sort(key=lambda entry: entry['uid'],
+                         reverse=sort_keys[0][1])
+            # the sort is stable, so sorting by the last key first keeps
+            # the order of the matches that tie on the first ones
+            for name, reverse in reversed(sort_keys):
+                matches.sort(key=_sort_key(name, _SORT_PROPERTIES[name]),
+                             reverse=reverse)
+        order_by = ','.join(order_by)
+
+        if after:
+            offset += _cursor_position(after, order_by, matches)
+
+        uids = [entry['uid'] for entry in matches[offset:offset + limit]]
+        info = {'next': ''}
+        if uids and offset + len(uids) < len(matches):
+            info['next'] = encode_cursor(CURSOR_OFFSET, order_by,
+                                         [str(offset + len(uids))])
+        # all matches are known, so the count is always exact
+        if count != COUNT_NONE:
+            info['count'] = len(matches)
+            info['count_exact'] = True
+        return uids, info
+
+    def get_facets(self, query, properties):
+        query = dict(query)
+        for name in ['offset', 'limit', 'order_by', 'after', 'count']:
+            query.pop(name, None)
+        query_string = query.pop('query', None)
+
+        for name in properties:
+            if name not in _SORT_PROPERTIES or name == 'title':
+                raise ValueError('Cannot count values of property %r' %
+                                 (name, ))
+
+        facets = dict([(name, {}) for name in properties])
+        for entry in self._match(query, query_string):
+            for name in properties:
+                value = entry.get(name)
+                if value:
+                    facets[name][value] = facets[name].get(value, 0) + 1
+        return facets
+
+    def _match(self, query, query_string):
+        filters = []
+        for name, value in query.items():
+            if name in _TERM_PROPERTIES:
+                filters.append(_term_filter(name, value))
+            elif name in _VALUE_PROPERTIES:
+                filters.append(_value_filter(name, _VALUE_PROPERTIES[name],
+                                             value))
+            else:
+                logging.warning('Unknown term: %r=%r', name, value)
+        if query_string:
+            filters.append(_text_filter(query_string))
+
+        return [entry for entry in self._entries.itervalues()
+                if all(f(entry) for f in filters)]
+
+
+def _cursor_position(cursor, order_by, matches):
+    kind, cursor_order_by, values = decode_cursor(cursor)
+    if cursor_order_by != order_by:
+        raise ValueError('Cursor is for sorting by %s, not %s' %
+                         (cursor_order_by, order_by))
+    if kind == CURSOR_OFFSET and len(values) == 1:
+        return int(values[0])
+    elif kind == CURSOR_KEYS and values:
+        # the last key is the uid of the last match returned
+        for position, entry in enumerate(matches):
+            if entry['uid'] == values[-1]:
+                return position + 1
+        raise ValueError('Cursor points to an entry not scanned yet')
+    raise ValueError('Invalid cursor %r' % (cursor, ))
+
+
+def _term_filter(name, value):
+    if isinstance(value, list):
+        values = set([_to_str(word) for word in value])
+    else:
+        values = set([_to_str(value)])
+    return lambda entry: entry.get(name) in values
+
+
+def _value_filter(name, value_type, value):
+    ranges = []
+    for word in (value if isinstance(value, list) else [value]):
+        if isinstance(word, tuple):
+            if len(word) != 2:
+                raise TypeError(
+                    'Only tuples of size 2 have a defined meaning. '
+                    'Did you mean to pass a list instead?')
+            start, end = word
+        elif isinstance(word, dict):
+            # compatibility option for timestamp: {'start': 0, 'end': 1}
+            start = word.get('start', 0)
+            end = word.get('end', sys.maxint)
+        else:
+            start = end = word
+        ranges.append((value_type(start), value_type(end)))
+
+    def matches(entry):
+        try:
+            entry_value = value_type(float(entry[name]))
+        except (KeyError, ValueError):
+            return False
+        for start, end in ranges:
+            if start <= entry_value <= end:
+                return True
+        return False
+
+    return matches
+
+
+def _text_filter(query_string):
+    words = []
+    prefixes = []
+    for word, wildcard in _QUERY_WORD_RE.findall(_to_unicode(query_string)):
+        if wildcard:
+            prefixes.append(word.lower())
+        else:
+            words.append(word.lower())
+
+    def matches(entry):
+        text = ' '.join([entry.get(name, '') for name in _TEXT_PROPERTIES])
+        entry_words = set(_WORD_RE.findall(_to_unicode(text).lower()))
+        for word in words:
+            if word in entry_words:
+                return True
+        for prefix in prefixes:
+            for entry_word in entry_words:
+                if entry_word.startswith(prefix):
+                    return True
+        return False
+
+    return matches
+
+
+def _sort_key(name, value_type):
+    if value_type is str:
+        return lambda entry: entry.get(name, '')
+    elif value_type is get_collation_key:
+        return lambda entry: get_collation_key(entry.get(name, ''))
+
+    def key(entry):
+        try:
+            return value_type(float(entry.get(name, 0)))
+        except ValueError:
+            return 0
+    return key
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _to_unicode(value):
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
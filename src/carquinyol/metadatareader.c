@@ -1,219 +1,345 @@
 #include "Python.h"
 
-#include <dirent.h>
+#include <arpa/inet.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 // TODO: put it in a place where python can use it when writing metadata
 #define MAX_PROPERTY_LENGTH 500 * 1024
 
+// A record holds all the properties of an entry, so allow for a few big ones
+#define MAX_RECORD_LENGTH 16 * 1024 * 1024
+
+// Keep in sync with metadatastore.py
+#define RECORD_MAGIC "CQM1"
+#define RECORD_MAGIC_LENGTH 4
+
 static PyObject *byte_array_type = NULL;
 
-int
-add_property (const char *metadata_path, char *property_name, PyObject * dict,
-        int must_exist) {
-    int file_path_size;
-    char *file_path = NULL;
-    FILE *file = NULL;
-    long file_size;
-    char *value_buf = NULL;
-    PyObject *value = NULL;
-    struct stat file_stat;
+static int
+read_length (const char *buf, size_t buf_size, size_t * pos, size_t * length) {
+    uint32_t value;
 
-    // Build path of the property file
-    file_path_size = strlen (metadata_path) + 1 + strlen (property_name) + 1;
-    file_path = PyMem_Malloc (file_path_size);
-    if (file_path == NULL) {
-        PyErr_NoMemory ();
+    if (buf_size - *pos < sizeof (value))
         return 0;
-    }
-    snprintf (file_path, file_path_size, "%s/%s", metadata_path, property_name);
 
-    if ((!must_exist) && (stat (file_path, &file_stat) != 0)) {
-        PyMem_Free (file_path);
+    memcpy (&value, buf + *pos, sizeof (value));
+    *pos += sizeof (value);
+    *length = ntohl (value);
+
+    return buf_size - *pos >= *length;
+}
+
+static int
+wanted_property (PyObject * properties, PyObject * key) {
+    if (properties == NULL)
         return 1;
-    }
 
-    file = fopen (file_path, "r");
-    if (file == NULL) {
-        char buf[256];
-        snprintf (buf, sizeof (buf), "Cannot open property file %s: %s",
-                file_path, strerror (errno));
-        PyErr_SetString (PyExc_IOError, buf);
-        goto cleanup;
-    }
-    // Get file size
-    fseek (file, 0, SEEK_END);
-    file_size = ftell (file);
-    rewind (file);
+    return PySequence_Contains (properties, key);
+}
 
-    if (file_size == 0) {
-        // Empty property
-        fclose (file);
-        file = NULL;
+static PyObject *
+build_value (const char *value_buf, size_t value_size) {
+    PyObject *args = NULL;
+    PyObject *value = NULL;
 
+    if (value_size == 0) {
+        // Empty property
         value = PyString_FromString ("");
         if (value == NULL) {
             PyErr_SetString (PyExc_ValueError,
                     "Failed to convert value to python string");
-            goto cleanup;
-        }
-    } else {
-        if (file_size > MAX_PROPERTY_LENGTH) {
-            PyErr_SetString (PyExc_ValueError, "Property file too big");
-            goto cleanup;
-        }
-        // Read the whole file
-        value_buf = PyMem_Malloc (file_size);
-        if (value_buf == NULL) {
-            PyErr_NoMemory ();
-            goto cleanup;
-        }
-        long read_size = fread (value_buf, 1, file_size, file);
-        if (read_size < file_size) {
-            char buf[256];
-            snprintf (buf, sizeof (buf),
-                    "Error while reading property file %s", file_path);
-            PyErr_SetString (PyExc_IOError, buf);
-            goto cleanup;
         }
+        return value;
+    }
 
-        fclose (file);
-        file = NULL;
+    // Convert value to dbus.ByteArray
+    args = Py_BuildValue ("(s#)", value_buf, (int) value_size);
+    if (args == NULL)
+        return NULL;
+
+    value = PyObject_CallObject (byte_array_type, args);
+    Py_DECREF (args);
+
+    if (value == NULL) {
+        PyErr_SetString (PyExc_ValueError,
+                "Failed to convert value to dbus.ByteArray");
+    }
+    return value;
+}
 
-        // Convert value to dbus.ByteArray
-        PyObject *args = Py_BuildValue ("(s#)", value_buf, file_size);
+/* Parse a packed metadata record. The record starts with RECORD_MAGIC and
+ * is followed by (key length, key, value length, value) tuples, lengths
+ * being 32 bit unsigned integers in network byte order.
+ *
+ * If properties is not NULL, only the keys contained in it are added.
+ */
+static PyObject *
+parse_record (const char *buf, size_t buf_size, PyObject * properties,
+        const char *record_path) {
+    PyObject *dict = NULL;
+    PyObject *key = NULL;
+    PyObject *value = NULL;
+    size_t pos = RECORD_MAGIC_LENGTH;
+    size_t key_size;
+    size_t value_size;
+    const char *key_buf;
+    const char *value_buf;
+    int wanted;
+
+    if ((buf_size < RECORD_MAGIC_LENGTH) ||
+            (memcmp (buf, RECORD_MAGIC, RECORD_MAGIC_LENGTH) != 0))
+        goto corrupt;
+
+    dict = PyDict_New ();
+    if (dict == NULL)
+        return NULL;
 
-        PyMem_Free (value_buf);
-        value_buf = NULL;
+    while (pos < buf_size) {
+        if (!read_length (buf, buf_size, &pos, &key_size))
+            goto corrupt;
+        key_buf = buf + pos;
+        pos += key_size;
 
-        value = PyObject_CallObject (byte_array_type, args);
-        Py_DECREF (args);
+        if (!read_length (buf, buf_size, &pos, &value_size))
+            goto corrupt;
+        value_buf = buf + pos;
+        pos += value_size;
 
-        if (value == NULL) {
-            PyErr_SetString (PyExc_ValueError,
-                    "Failed to convert value to dbus.ByteArray");
+        key = PyString_FromStringAndSize (key_buf, key_size);
+        if (key == NULL)
+            goto cleanup;
+
+        wanted = wanted_property (properties, key);
+        if (wanted == -1)
             goto cleanup;
+
+        if (wanted) {
+            if (value_size > MAX_PROPERTY_LENGTH) {
+                PyErr_SetString (PyExc_ValueError, "Property too big");
+                goto cleanup;
+            }
+
+            value = build_value (value_buf, value_size);
+            if (value == NULL)
+                goto cleanup;
+
+            // Add property to the metadata dict
+            if (PyDict_SetItem (dict, key, value) == -1) {
+                PyErr_SetString (PyExc_ValueError,
+                        "Failed to add property to dictionary");
+                goto cleanup;
+            }
+            Py_DECREF (value);
+            value = NULL;
         }
-    }
 
-    // Add property to the metadata dict
-    if (PyDict_SetItemString (dict, property_name, value) == -1) {
-        PyErr_SetString (PyExc_ValueError,
-                "Failed to add property to dictionary");
-        goto cleanup;
+        Py_DECREF (key);
+        key = NULL;
     }
 
-    Py_DECREF (value);
-    PyMem_Free (file_path);
+    return dict;
 
-    return 1;
+  corrupt:
+    PyErr_Format (PyExc_ValueError, "Corrupt metadata record %s",
+            record_path);
 
   cleanup:
-    if (file_path) {
-        PyMem_Free (file_path);
-    }
-    if (value_buf) {
-        PyMem_Free (value_buf);
+    Py_XDECREF (dict);
+    Py_XDECREF (key);
+    Py_XDECREF (value);
+    return NULL;
+}
+
+/* Read the whole record file at record_path into buf, growing it as needed.
+ * Returns the size of the record or -1 on error. If allow_missing is set,
+ * returns -2 without raising an exception if the record doesn't exist.
+ */
+static Py_ssize_t
+read_record (const char *record_path, char **buf, size_t * buf_size,
+        int allow_missing) {
+    int fd;
+    struct stat file_stat;
+    size_t record_size;
+    size_t read_size = 0;
+    ssize_t count;
+    char *new_buf;
+
+    fd = open (record_path, O_RDONLY);
+    if (fd == -1 && allow_missing && errno == ENOENT)
+        return -2;
+    if (fd == -1) {
+        PyErr_Format (PyExc_IOError, "Cannot open metadata record %s: %s",
+                record_path, strerror (errno));
+        return -1;
     }
-    if (file) {
-        fclose (file);
+
+    if (fstat (fd, &file_stat) != 0) {
+        PyErr_Format (PyExc_IOError, "Cannot stat metadata record %s: %s",
+                record_path, strerror (errno));
+        goto cleanup;
     }
-    if (value) {
-        Py_DECREF (value);
+
+    record_size = file_stat.st_size;
+    if (record_size > MAX_RECORD_LENGTH) {
+        PyErr_SetString (PyExc_ValueError, "Metadata record too big");
+        goto cleanup;
     }
-    return 0;
-}
 
-static PyObject *read_from_properties_list (const char *metadata_path,
-        PyObject * properties) {
-    PyObject *dict = PyDict_New ();
+    if (record_size > *buf_size) {
+        new_buf = PyMem_Realloc (*buf, record_size);
+        if (new_buf == NULL) {
+            PyErr_NoMemory ();
+            goto cleanup;
+        }
+        *buf = new_buf;
+        *buf_size = record_size;
+    }
 
-    int i;
-    for (i = 0; i < PyList_Size (properties); i++) {
-        PyObject *property = PyList_GetItem (properties, i);
-        char *property_name = PyString_AsString (property);
+    while (read_size < record_size) {
+        Py_BEGIN_ALLOW_THREADS
+        count = read (fd, *buf + read_size, record_size - read_size);
+        Py_END_ALLOW_THREADS
 
-        if (add_property (metadata_path, property_name, dict, 0) == 0)
+        if (count == -1 && errno == EINTR)
+            continue;
+        if (count <= 0) {
+            PyErr_Format (PyExc_IOError,
+                    "Error while reading metadata record %s", record_path);
             goto cleanup;
+        }
+        read_size += count;
     }
 
-    return dict;
+    close (fd);
+    return record_size;
 
   cleanup:
-    if (dict) {
-        Py_DECREF (dict);
+    close (fd);
+    return -1;
+}
+
+static PyObject *
+get_properties_filter (PyObject * properties) {
+    if ((properties == Py_None) || (PySequence_Size (properties) == 0)) {
+        PyErr_Clear ();
+        return NULL;
     }
-    return NULL;
+    return properties;
 }
 
-static PyObject *read_all_properties (const char *metadata_path) {
-    PyObject *dict = PyDict_New ();
-    DIR *dir_stream = NULL;
-    struct dirent *dir_entry = NULL;
-
-    dir_stream = opendir (metadata_path);
-    if (dir_stream == NULL) {
-        char buf[256];
-        snprintf (buf, sizeof (buf), "Couldn't open metadata directory %s",
-                metadata_path);
-        PyErr_SetString (PyExc_IOError, buf);
-        goto cleanup;
+static PyObject *metadatareader_retrieve (PyObject * unused, PyObject * args) {
+    PyObject *dict = NULL;
+    PyObject *properties = NULL;
+    const char *record_path = NULL;
+    char *buf = NULL;
+    size_t buf_size = 0;
+    Py_ssize_t record_size;
+
+    if (!PyArg_ParseTuple (args, "sO:retrieve", &record_path, &properties))
+        return NULL;
+
+    record_size = read_record (record_path, &buf, &buf_size, 0);
+    if (record_size != -1) {
+        dict = parse_record (buf, record_size,
+                get_properties_filter (properties), record_path);
     }
 
-    dir_entry = readdir (dir_stream);
-    while (dir_entry != NULL) {
-        // Skip '.', '..', and any .hidden file
-        if (dir_entry->d_name[0] == '.')
-            goto next_property;
+    PyMem_Free (buf);
+    return dict;
+}
+
+static PyObject *metadatareader_retrieve_many (PyObject * unused,
+        PyObject * args) {
+    PyObject *list = NULL;
+    PyObject *paths = NULL;
+    PyObject *paths_seq = NULL;
+    PyObject *properties = NULL;
+    PyObject *dict = NULL;
+    const char *record_path = NULL;
+    char *buf = NULL;
+    size_t buf_size = 0;
+    Py_ssize_t record_size;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple (args, "OO:retrieve_many", &paths, &properties))
+        return NULL;
+
+    paths_seq = PySequence_Fast (paths, "paths must be a sequence");
+    if (paths_seq == NULL)
+        return NULL;
 
-        if (add_property (metadata_path, dir_entry->d_name, dict, 1) == 0)
+    properties = get_properties_filter (properties);
+
+    list = PyList_New (PySequence_Fast_GET_SIZE (paths_seq));
+    if (list == NULL)
+        goto cleanup;
+
+    // The scratch buffer is shared by all records of the page
+    for (i = 0; i < PySequence_Fast_GET_SIZE (paths_seq); i++) {
+        record_path =
+                PyString_AsString (PySequence_Fast_GET_ITEM (paths_seq, i));
+        if (record_path == NULL)
             goto cleanup;
 
-      next_property:
-        dir_entry = readdir (dir_stream);
-    }
+        record_size = read_record (record_path, &buf, &buf_size, 1);
+        if (record_size == -1)
+            goto cleanup;
+        if (record_size == -2) {
+            // Missing entries are reported to the caller as None
+            Py_INCREF (Py_None);
+            PyList_SET_ITEM (list, i, Py_None);
+            continue;
+        }
 
-    closedir (dir_stream);
+        dict = parse_record (buf, record_size, properties, record_path);
+        if (dict == NULL)
+            goto cleanup;
+        PyList_SET_ITEM (list, i, dict);
+    }
 
-    return dict;
+    PyMem_Free (buf);
+    Py_DECREF (paths_seq);
+    return list;
 
   cleanup:
-    if (dict) {
-        Py_DECREF (dict);
-    }
-    if (dir_stream) {
-        closedir (dir_stream);
-    }
+    PyMem_Free (buf);
+    Py_DECREF (paths_seq);
+    Py_XDECREF (list);
     return NULL;
 }
 
-static PyObject *metadatareader_retrieve (PyObject * unused, PyObject * args) {
-    PyObject *dict = NULL;
+static PyObject *metadatareader_parse (PyObject * unused, PyObject * args) {
     PyObject *properties = NULL;
-    const char *metadata_path = NULL;
+    const char *buf = NULL;
+    int buf_size;
 
-    if (!PyArg_ParseTuple (args, "sO:retrieve", &metadata_path, &properties))
+    if (!PyArg_ParseTuple (args, "s#O:parse", &buf, &buf_size, &properties))
         return NULL;
 
-    if ((properties != Py_None) && (PyList_Size (properties) > 0)) {
-        dict = read_from_properties_list (metadata_path, properties);
-    } else {
-        dict = read_all_properties (metadata_path);
-    }
-
-    return dict;
+    return parse_record (buf, buf_size, get_properties_filter (properties),
+            "buffer");
 }
 
 static PyMethodDef metadatareader_functions[] = {
     {"retrieve", metadatareader_retrieve, METH_VARARGS,
             PyDoc_STR
-                ("Read a dictionary from a directory with a single file "
-                        "(containing the content) per key")},
+                ("Read a dictionary from a packed metadata record file")},
+    {"retrieve_many", metadatareader_retrieve_many, METH_VARARGS,
+            PyDoc_STR
+                ("Read a list of dictionaries from packed metadata record "
+                        "files, with None for each missing record")},
+    {"parse", metadatareader_parse, METH_VARARGS,
+            PyDoc_STR
+                ("Read a dictionary from a packed metadata record string")},
     {NULL, NULL, 0, NULL}
 };
 
 PyMODINIT_FUNC initmetadatareader (void) {
-    PyObject *mod;
-    mod = Py_InitModule ("metadatareader", metadatareader_functions);
+    Py_InitModule ("metadatareader", metadatareader_functions);
 
     PyObject *dbus_module = PyImport_ImportModule ("dbus");
     byte_array_type = PyObject_GetAttrString (dbus_module, "ByteArray");
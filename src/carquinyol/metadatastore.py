@@ -1,77 +1,254 @@
 import os
+import struct
 
 from carquinyol import layoutmanager
 from carquinyol import metadatareader
+from carquinyol.lrucache import LRUCache
 
 MAX_SIZE = 256
 _INTERNAL_KEYS = ['checksum']
 
+# Default bounds of the metadata cache, in entries and in bytes of values
+_CACHE_MAX_ENTRIES = 2000
+_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+# Bigger values (typically previews) are never cached, only their presence
+_CACHE_MAX_VALUE_SIZE = 4096
+
+# Keep in sync with metadatareader.c
+_RECORD_MAGIC = 'CQM1'
+
+
+def _encode_key(key):
+    # Hack to support activities that still pass properties named as
+    # for example title:text.
+    if ':' in key:
+        key = key.split(':', 1)[0]
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return str(key)
+
+
+def _encode_value(value):
+    # FIXME: this codepath handles raw image data
+    # str() is 8-bit clean right now, but
+    # this won't last. We will need more explicit
+    # handling of strings, int/floats vs raw data
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif not isinstance(value, basestring):
+        return str(value)
+    return value
+
+
+def encode_record(metadata):
+    """Pack a metadata dictionary in the format read by metadatareader.
+
+    Each property is written as its key and value, both prefixed by their
+    length as a 32 bit unsigned integer in network byte order.
+    """
+    chunks = [_RECORD_MAGIC]
+    for key, value in metadata.items():
+        key = _encode_key(key)
+        value = _encode_value(value)
+        chunks.append(struct.pack('!I', len(key)))
+        chunks.append(key)
+        chunks.append(struct.pack('!I', len(value)))
+        chunks.append(value)
+    return ''.join(chunks)
+
+
+def _get_record_path(uid):
+    return layoutmanager.get_instance().get_metadata_record_path(uid)
+
+
+def write_record(record_path, metadata):
+    """Replace the record at record_path atomically."""
+    temp_path = record_path + '.tmp'
+    f = open(temp_path, 'w')
+    try:
+        f.write(encode_record(metadata))
+    finally:
+        f.close()
+    os.rename(temp_path, record_path)
+
+
+class _CachedMetadata(object):
+    """Properties of a single entry known to the metadata cache.
+
+    Properties are cached individually as they get read, so an entry
+    retrieved with a list of properties only knows about those.
+    """
+
+    def __init__(self):
+        self.values = {}
+        # properties known not to be set for the entry
+        self.absent = set()
+        # properties that are set but too big to be cached
+        self.uncached = set()
+        # whether values, absent and uncached cover all properties
+        self.complete = False
+        self.size = 0
+
+    def lookup(self, properties):
+        """Return the requested properties or None if any isn't known."""
+        if not properties:
+            if not self.complete or self.uncached:
+                return None
+            return dict(self.values)
+
+        metadata = {}
+        for name in properties:
+            if name in self.values:
+                metadata[name] = self.values[name]
+            elif name in self.uncached:
+                return None
+            elif name not in self.absent and not self.complete:
+                return None
+        return metadata
+
+    def update(self, properties, metadata):
+        """Add properties just read from disk."""
+        for name, value in metadata.items():
+            if name in self.values:
+                continue
+            if len(value) > _CACHE_MAX_VALUE_SIZE:
+                self.uncached.add(name)
+            else:
+                self.values[name] = value
+                self.size += len(name) + len(value)
+
+        if properties:
+            for name in properties:
+                if name not in metadata:
+                    self.absent.add(name)
+        else:
+            self.complete = True
+
 
 class MetadataStore(object):
 
+    def __init__(self, cache_entries=_CACHE_MAX_ENTRIES,
+                 cache_bytes=_CACHE_MAX_BYTES):
+        self._cache = LRUCache(cache_entries, cache_bytes)
+        self._cache_hits = 0
+        self._cache_misses = 0
+
     def store(self, uid, metadata):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        if not os.path.exists(metadata_path):
-            os.makedirs(metadata_path)
+        self._cache.remove(uid)
+
+        record_path = _get_record_path(uid)
+        entry_path = layoutmanager.get_instance().get_entry_path(uid)
+        if not os.path.exists(entry_path):
+            os.makedirs(entry_path)
+            stored = {}
         else:
-            received_keys = metadata.keys()
-            for key in os.listdir(metadata_path):
-                if key not in _INTERNAL_KEYS and key not in received_keys:
-                    os.remove(os.path.join(metadata_path, key))
+            stored = self._read_record(record_path)
 
         metadata['uid'] = uid
+        record = {}
+        for key, value in stored.items():
+            if key in _INTERNAL_KEYS:
+                record[key] = value
         for key, value in metadata.items():
-            self._set_property(uid, key, value, md_path=metadata_path)
-
-    def _set_property(self, uid, key, value, md_path=False):
-        if not md_path:
-            md_path = layoutmanager.get_instance().get_metadata_path(uid)
-        # Hack to support activities that still pass properties named as
-            # for example title:text.
-        if ':' in key:
-            key = key.split(':', 1)[0]
-
-        changed = True
-        fpath = os.path.join(md_path, key)
-        tpath = os.path.join(md_path, '.' + key)
-        # FIXME: this codepath handles raw image data
-        # str() is 8-bit clean right now, but
-        # this won't last. We will need more explicit
-        # handling of strings, int/floats vs raw data
-        if isinstance(value, unicode):
-            value = value.encode('utf-8')
-        elif not isinstance(value, basestring):
-            value = str(value)
+            record[_encode_key(key)] = _encode_value(value)
+
+        # avoid pointless writes
+        if record != stored:
+            write_record(record_path, record)
+
+    def _read_record(self, record_path):
+        if not os.path.exists(record_path):
+            return {}
+        return metadatareader.retrieve(record_path, None)
+
+    def _set_property(self, uid, key, value):
+        self._cache.remove(uid)
+
+        record_path = _get_record_path(uid)
+        record = self._read_record(record_path)
+
+        key = _encode_key(key)
+        value = _encode_value(value)
 
         # avoid pointless writes; replace atomically
-        if os.path.exists(fpath):
-            stored_val = open(fpath, 'r').read()
+        if record.get(key) != value:
+            record[key] = value
+            write_record(record_path, record)
+
+    def _lookup_cache(self, uid, properties):
+        cached = self._cache.get(uid)
+        if cached is not None:
+            metadata = cached.lookup(properties)
+            if metadata is not None:
+                self._cache_hits += 1
+                return metadata
 
-            if stored_val == value:
-                changed = False
-        if changed:
-            f = open(tpath, 'w')
-            f.write(value)
-            f.close()
-            os.rename(tpath, fpath)
+        self._cache_misses += 1
+        return None
+
+    def _update_cache(self, uid, properties, metadata):
+        cached = self._cache.get(uid)
+        if cached is None:
+            cached = _CachedMetadata()
+        cached.update(properties, metadata)
+        self._cache.set(uid, cached, cached.size)
 
     def retrieve(self, uid, properties=None):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        return metadatareader.retrieve(metadata_path, properties)
+        metadata = self._lookup_cache(uid, properties)
+        if metadata is not None:
+            return metadata
+
+        record_path = _get_record_path(uid)
+        metadata = metadatareader.retrieve(record_path, properties)
+        self._update_cache(uid, properties, metadata)
+        return metadata
+
+    def retrieve_many(self, uids, properties=None):
+        """Retrieve the metadata of several entries in a single call.
+
+        Returns a list of dictionaries in the same order as uids, with None
+        for the entries that don't have any metadata.
+        """
+        entries = [self._lookup_cache(uid, properties) for uid in uids]
+        missed = [i for i, metadata in enumerate(entries) if metadata is None]
+        if not missed:
+            return entries
+
+        record_paths = [_get_record_path(uids[i]) for i in missed]
+        metadatas = metadatareader.retrieve_many(record_paths, properties)
+        for i, metadata in zip(missed, metadatas):
+            if metadata is not None:
+                self._update_cache(uids[i], properties, metadata)
+            entries[i] = metadata
+
+        return entries
 
     def delete(self, uid):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        for key in os.listdir(metadata_path):
-            os.remove(os.path.join(metadata_path, key))
-        os.rmdir(metadata_path)
+        self._cache.remove(uid)
+
+        record_path = _get_record_path(uid)
+        if os.path.exists(record_path):
+            os.remove(record_path)
 
     def get_property(self, uid, key):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        property_path = os.path.join(metadata_path, key)
-        if os.path.exists(property_path):
-            return open(property_path, 'r').read()
-        else:
+        metadata = self._lookup_cache(uid, [key])
+        if metadata is not None:
+            return metadata.get(key)
+
+        record_path = _get_record_path(uid)
+        if not os.path.exists(record_path):
             return None
+        metadata = metadatareader.retrieve(record_path, [key])
+        self._update_cache(uid, [key], metadata)
+        return metadata.get(key)
 
     def set_property(self, uid, key, value):
         self._set_property(uid, key, value)
+
+    def get_cache_stats(self):
+        """Return the hit and miss counters and the usage of the cache."""
+        return {'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'entries': len(self._cache),
+                'bytes': self._cache.get_size()}
@@ -24,6 +24,7 @@ import time
 import json
 
 from carquinyol import layoutmanager
+from carquinyol import metadatastore
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
@@ -100,3 +101,89 @@ def _migrate_preview(root_path, old_root_path, uid):
     metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
     os.rename(os.path.join(old_root_path, 'preview', uid),
               os.path.join(metadata_path, 'preview'))
+
+
+def migrate_checksums(checksum_store):
+    """Move the groups of identical files from the checksums directory,
+    where each one used to be a directory with an empty file per entry,
+    into checksum_store.
+    """
+    checksums_dir = layoutmanager.get_instance().get_checksums_dir()
+    if not os.path.isdir(checksums_dir):
+        return
+
+    checksums = [name for name in os.listdir(checksums_dir)
+                 if name != 'queue' and
+                 os.path.isdir(os.path.join(checksums_dir, name))]
+    if not checksums:
+        return
+
+    logging.info('Migrating %d checksums', len(checksums))
+    entries = []
+    for checksum in checksums:
+        for uid in os.listdir(os.path.join(checksums_dir, checksum)):
+            entries.append((uid, checksum))
+    checksum_store.add_many(entries)
+
+    for checksum in checksums:
+        shutil.rmtree(os.path.join(checksums_dir, checksum))
+    logging.info('Migration finished')
+
+
+def migrate_optimizer_queue(queue):
+    """Move the entries waiting to be optimized from the queue directory,
+    where each one used to be an empty file, into queue.
+
+    Must be called after migrate_checksums(), as the checksums directory
+    gets removed once empty.
+    """
+    layout_manager = layoutmanager.get_instance()
+    queue_path = layout_manager.get_queue_path()
+    if os.path.isdir(queue_path):
+        uids = os.listdir(queue_path)
+        logging.info('Migrating %d queued entries', len(uids))
+        for uid in uids:
+            queue.push(uid)
+        shutil.rmtree(queue_path)
+
+    checksums_dir = layout_manager.get_checksums_dir()
+    if os.path.isdir(checksums_dir) and not os.listdir(checksums_dir):
+        os.rmdir(checksums_dir)
+
+
+def migrate_from_6():
+    """Pack the per-property metadata files of each entry into a single
+    record file.
+    """
+    logging.info('Migrating datastore from version 6 to version 7')
+
+    layout_manager = layoutmanager.get_instance()
+    for uid in layout_manager.find_all():
+        metadata_path = layout_manager.get_metadata_path(uid)
+        if not os.path.isdir(metadata_path):
+            continue
+
+        logging.debug('Migrating entry %r', uid)
+        try:
+            _pack_metadata(uid, metadata_path)
+        except Exception:
+            logging.exception('Error while migrating entry %r', uid)
+
+    logging.info('Migration finished')
+
+
+def _pack_metadata(uid, metadata_path):
+    metadata = {}
+    for key in os.listdir(metadata_path):
+        # Skip any .hidden file, e.g. left over from an interrupted write
+        if key.startswith('.'):
+            continue
+        f = open(os.path.join(metadata_path, key), 'r')
+        try:
+            metadata[key] = f.read()
+        finally:
+            f.close()
+
+    record_path = layoutmanager.get_instance().get_metadata_record_path(uid)
+    metadatastore.write_record(record_path, metadata)
+    shutil.rmtree(metadata_path)
@@ -15,23 +15,210 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-import errno
+import hashlib
 import logging
-import subprocess
+import time
 
 from gi.repository import GObject
 
 from carquinyol import layoutmanager
+from carquinyol import migration
+from carquinyol.checksumstore import ChecksumStore
+from carquinyol.journal import JournaledQueue
+from carquinyol.workers import WorkerPool
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+# Checksums are stored as '<algorithm>:<hex digest>', except for md5 ones,
+# which are stored as the bare digest like before other algorithms got
+# supported.
+if blake2b is not None:
+    CHECKSUM_ALGORITHM = 'blake2b'
+else:
+    CHECKSUM_ALGORITHM = 'md5'
+
+_READ_SIZE = 1024 * 1024
+
+# Size of the blocks at the start and the end of a file compared before
+# hashing all of it
+_PARTIAL_SIZE = 64 * 1024
+
+# Maximum number of entries with the same file size to compare an entry to
+_MAX_CANDIDATES = 100
+
+# Number of queued entries processed at once
+_BATCH_SIZE = 20
+
+
+def calculate_checksum(path, legacy=False):
+    """Calculate the checksum of a file.
+
+    Returns a pair of the checksum and, if legacy is set, the md5 checksum
+    of the file, else None. Releases the GIL while hashing, so it's fine to
+    be called on a worker thread.
+    """
+    hashes = [_new_hash(CHECKSUM_ALGORITHM)]
+    if legacy:
+        hashes.append(hashlib.md5())
+
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            for hash_object in hashes:
+                hash_object.update(data)
+    finally:
+        f.close()
+
+    checksum = _format_checksum(CHECKSUM_ALGORITHM, hashes[0].hexdigest())
+    if legacy:
+        return checksum, hashes[1].hexdigest()
+    return checksum, None
+
+
+def find_duplicates(path, candidates, legacy=False, checksums=None):
+    """Calculate the checksums needed to find the files identical to the
+    one at path.
+
+    candidates is a list of (uid, path, has_checksum) tuples for files of
+    the same size, or None if they are unknown. The file only gets hashed
+    in full if the first and last blocks of some candidate match, and so
+    do the candidates without a checksum yet. checksums is an optional
+    dictionary of the results of calculate_checksum() by path, used and
+    filled in to avoid hashing files again.
+
+    Runs on a worker thread. Returns the result of calculate_checksum()
+    for the file, or (None, None) if no candidate can be identical, plus a
+    dictionary of the results for the candidates, by uid.
+    """
+    if checksums is None:
+        checksums = {}
+
+    if candidates is None:
+        return _get_checksum(path, legacy, checksums), {}
+
+    size = os.path.getsize(path)
+    partial_checksum = _calculate_partial_checksum(path, size)
+    matches = []
+    for uid, candidate_path, has_checksum in candidates:
+        try:
+            if os.path.getsize(candidate_path) == size and \
+                    _calculate_partial_checksum(candidate_path, size) == \
+                    partial_checksum:
+                matches.append((uid, candidate_path, has_checksum))
+        except (IOError, OSError):
+            # deleted in the meantime
+            continue
+
+    if not matches:
+        return (None, None), {}
+
+    candidate_checksums = {}
+    for uid, candidate_path, has_checksum in matches:
+        if not has_checksum:
+            try:
+                candidate_checksums[uid] = _get_checksum(candidate_path,
+                                                         legacy, checksums)
+            except (IOError, OSError):
+                continue
+    return _get_checksum(path, legacy, checksums), candidate_checksums
+
+
+def _get_checksum(path, legacy, checksums):
+    if path not in checksums:
+        checksums[path] = calculate_checksum(path, legacy)
+    return checksums[path]
+
+
+def _find_duplicates_batch(jobs, legacy):
+    """Call find_duplicates() for a list of (uid, path, candidates) tuples.
+
+    Runs on a worker thread. Returns a list of (uid, result, exception)
+    tuples, with either the result of find_duplicates() or the exception it
+    raised set.
+    """
+    results = []
+    # candidates of several entries only need to be hashed once
+    checksums = {}
+    for uid, path, candidates in jobs:
+        try:
+            results.append((uid, find_duplicates(path, candidates, legacy,
+                                                 checksums), None))
+        except Exception, e:
+            results.append((uid, None, e))
+    return results
+
+
+def _calculate_partial_checksum(path, size):
+    hash_object = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        hash_object.update(f.read(_PARTIAL_SIZE))
+        if size > 2 * _PARTIAL_SIZE:
+            f.seek(-_PARTIAL_SIZE, os.SEEK_END)
+        hash_object.update(f.read(_PARTIAL_SIZE))
+    finally:
+        f.close()
+    return hash_object.digest()
+
+
+def _new_hash(algorithm):
+    if algorithm == 'blake2b':
+        return blake2b()
+    return hashlib.new(algorithm)
+
+
+def _format_checksum(algorithm, digest):
+    if algorithm == 'md5':
+        return digest
+    return '%s:%s' % (algorithm, digest)
 
 
 class Optimizer(object):
     """Optimizes disk space usage by detecting duplicates and sharing storage.
     """
 
-    def __init__(self, file_store, metadata_store):
+    def __init__(self, file_store, metadata_store, index_store):
         self._file_store = file_store
         self._metadata_store = metadata_store
+        # finds the entries with files of the same size
+        self._index_store = index_store
         self._enqueue_checksum_id = None
+        self._workers = WorkerPool(1, 'optimizer')
+        # entries being hashed on the worker thread, the ones among them
+        # that got queued again and the entries changed in the meantime
+        self._hashing_uids = set()
+        self._requeued_uids = set()
+        self._changed_uids = set()
+        # Entries processed without hashing their file, since no other one
+        # had the same size, are recorded without a checksum. Other entries
+        # may not be hashed as candidates, as their file could be still
+        # being written.
+        layout_manager = layoutmanager.get_instance()
+        self._checksum_store = ChecksumStore(
+            layout_manager.get_checksums_db_path())
+        migration.migrate_checksums(self._checksum_store)
+        # entries stay queued until processed, so that the ones left when
+        # the data store stopped get processed after it starts again
+        self._queue = JournaledQueue(
+            layout_manager.get_optimizer_queue_path())
+        migration.migrate_optimizer_queue(self._queue)
+        # whether md5 checksums are still to be converted to
+        # CHECKSUM_ALGORITHM, checked on first use
+        self._legacy_checksums = None
+        self._processed = 0
+        self._batch_start = 0
+        self._batch_processed = 0
+        self._drain_rate = 0.0
+        self._schedule()
 
     def optimize(self, uid):
         """Add an entry to a queue of entries to be checked for duplicates.
@@ -40,11 +227,23 @@ class Optimizer(object):
         if not os.path.exists(self._file_store.get_file_path(uid)):
             return
 
-        queue_path = layoutmanager.get_instance().get_queue_path()
-        open(os.path.join(queue_path, uid), 'w').close()
-        logging.debug('optimize %r', os.path.join(queue_path, uid))
+        logging.debug('optimize %r', uid)
+        self._queue.push(uid)
+        if uid in self._hashing_uids:
+            self._requeued_uids.add(uid)
+        self._schedule()
+
+    def get_stats(self):
+        """Return the number of queued entries, the number of entries
+        processed and the entries processed per second by the last batch.
+        """
+        return {'queue_depth': len(self._queue),
+                'processed': self._processed,
+                'drain_rate': self._drain_rate}
 
-        if self._enqueue_checksum_id is None:
+    def _schedule(self):
+        if self._enqueue_checksum_id is None and not self._hashing_uids \
+                and len(self._queue):
             self._enqueue_checksum_id = \
                     GObject.idle_add(self._process_entry_cb,
                                      priority=GObject.PRIORITY_LOW)
@@ -53,115 +252,177 @@ class Optimizer(object):
         """Remove any structures left from space optimization
 
         """
-        checksum = self._metadata_store.get_property(uid, 'checksum')
-        if checksum is None:
-            return
-
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        checksum_entry_path = os.path.join(checksum_path, uid)
-
-        if os.path.exists(checksum_entry_path):
-            logging.debug('remove %r', checksum_entry_path)
-            os.remove(checksum_entry_path)
-
-        if os.path.exists(checksum_path):
-            try:
-                os.rmdir(checksum_path)
-                logging.debug('removed %r', checksum_path)
-            except OSError, e:
-                if e.errno != errno.ENOTEMPTY:
-                    raise
+        if self._hashing_uids:
+            self._changed_uids.add(uid)
+        logging.debug('remove %r from checksums', uid)
+        self._checksum_store.remove(uid)
 
-    def _identical_file_already_exists(self, checksum):
-        """Check if we already have files with this checksum.
-
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        return os.path.exists(checksum_path)
-
-    def _get_uid_from_checksum(self, checksum):
-        """Get an existing entry which file matches checksum.
-
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        first_uid = os.listdir(checksum_path)[0]
-        return first_uid
-
-    def _create_checksum_dir(self, checksum):
-        """Create directory that tracks files with this same checksum.
-
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        logging.debug('create dir %r', checksum_path)
-        os.mkdir(checksum_path)
-
-    def _add_checksum_entry(self, uid, checksum):
-        """Create a file in the checksum dir with the uid of the entry
-
-        """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-
-        logging.debug('touch %r', os.path.join(checksum_path, uid))
-        open(os.path.join(checksum_path, uid), 'w').close()
+    def _has_legacy_checksums(self):
+        if CHECKSUM_ALGORITHM == 'md5':
+            return False
+        if self._legacy_checksums is None:
+            self._legacy_checksums = \
+                self._checksum_store.has_legacy_checksums()
+        return self._legacy_checksums
 
-    def _already_linked(self, uid, checksum):
-        """Check if this entry's file is already a hard link to the checksums
-           dir.
+    def _convert_legacy_checksum(self, legacy_checksum, checksum):
+        """Move the entries of a group of identical files found by their
+           md5 checksum to the group for their current checksum.
 
         """
-        checksums_dir = layoutmanager.get_instance().get_checksums_dir()
-        checksum_path = os.path.join(checksums_dir, checksum)
-        return os.path.exists(os.path.join(checksum_path, uid))
+        logging.debug('converting %r to %r', legacy_checksum, checksum)
+        uids = self._checksum_store.replace_checksum(legacy_checksum,
+                                                     checksum)
+        for uid in uids:
+            self._metadata_store.set_property(uid, 'checksum', checksum)
+        # check again on next use
+        self._legacy_checksums = None
 
     def _process_entry_cb(self):
-        """Process one item in the checksums queue by calculating its checksum,
-           checking if there exist already an identical file, and in that case
-           substituting its file with a hard link to that pre-existing file.
+        """Process a batch of entries from the head of the queue by looking
+           for entries with files of the same size and, for those that have
+           any, comparing the files on a worker thread, see _checksum_cb().
 
         """
-        queue_path = layoutmanager.get_instance().get_queue_path()
-        queue = os.listdir(queue_path)
-        if queue:
-            uid = queue[0]
-            logging.debug('_process_entry_cb processing %r', uid)
+        self._enqueue_checksum_id = None
+        self._batch_start = time.time()
 
+        jobs = []
+        processed = 0
+        for uid in self._queue.peek(_BATCH_SIZE):
             file_in_entry_path = self._file_store.get_file_path(uid)
             if not os.path.exists(file_in_entry_path):
                 logging.info('non-existent entry in queue: %r', uid)
-            else:
-                checksum = self._calculate_md5sum(file_in_entry_path)
-                self._metadata_store.set_property(uid, 'checksum', checksum)
+                self._queue.remove(uid)
+                continue
+
+            size = os.path.getsize(file_in_entry_path)
+            candidates = self._find_candidates(uid, size)
+            if candidates == []:
+                # no other file can be identical, don't bother hashing it
+                logging.debug('%r has a file of unique size', uid)
+                self._checksum_store.add(uid, None)
+                self._queue.remove(uid)
+                processed += 1
+                continue
+
+            jobs.append((uid, file_in_entry_path, candidates))
+
+        if not jobs:
+            self._update_stats(processed)
+            self._schedule()
+            return False
 
-                if self._identical_file_already_exists(checksum):
-                    if not self._already_linked(uid, checksum):
-                        existing_entry_uid = \
-                                self._get_uid_from_checksum(checksum)
+        logging.debug('_process_entry_cb hashing %d entries', len(jobs))
+        self._hashing_uids = set([job[0] for job in jobs])
+        self._requeued_uids.clear()
+        self._changed_uids.clear()
+        legacy = self._has_legacy_checksums()
+        self._batch_processed = processed
+        self._workers.submit(_find_duplicates_batch, (jobs, legacy),
+                             self._checksum_cb)
+        return False
 
-                        self._file_store.hard_link_entry(uid,
-                                                         existing_entry_uid)
+    def _find_candidates(self, uid, size):
+        """Return the (uid, path, has_checksum) tuples of the other entries
+           with a file of the given size, or None if they can't be told.
 
-                        self._add_checksum_entry(uid, checksum)
-                else:
-                    self._create_checksum_dir(checksum)
-                    self._add_checksum_entry(uid, checksum)
+        """
+        if size == 0:
+            # nothing to save by linking empty files
+            return []
+
+        try:
+            uids, __ = self._index_store.find({'filesize': size,
+                                               'limit': _MAX_CANDIDATES + 1,
+                                               'count': 'none'})
+        except Exception:
+            logging.exception('Error looking up entries of size %d', size)
+            return None
+
+        candidates = []
+        for candidate_uid in uids:
+            if candidate_uid == uid:
+                continue
+            has_checksum = self._checksum_store.get_checksum(
+                candidate_uid) is not None
+            if has_checksum or \
+                    self._checksum_store.is_unhashed(candidate_uid):
+                path = self._file_store.get_file_path(candidate_uid)
+                candidates.append((candidate_uid, path, has_checksum))
+        return candidates[:_MAX_CANDIDATES]
+
+    def _checksum_cb(self, results, exc):
+        """Add the entries just hashed and the candidates hashed along with
+           them to the groups of identical files.
 
-            os.remove(os.path.join(queue_path, uid))
+        """
+        if exc is not None:
+            # _find_duplicates_batch handles errors of single entries, so
+            # this is a bug; drop the batch rather than retrying it forever
+            logging.error('Error processing batch of entries: %r', exc)
+            results = [(uid, None, exc) for uid in self._hashing_uids]
+
+        for uid, result, error in results:
+            self._add_result(uid, result, error)
+
+        self._hashing_uids.clear()
+        self._requeued_uids.clear()
+        self._changed_uids.clear()
+        self._update_stats(self._batch_processed + len(results))
+        self._schedule()
+
+    def _add_result(self, uid, result, error):
+        if uid in self._requeued_uids:
+            # its file may have changed, calculate the checksum again
+            logging.debug('%r queued while calculating its checksum', uid)
+            return
 
-        if len(queue) <= 1:
-            self._enqueue_checksum_id = None
-            return False
+        if uid in self._changed_uids:
+            # the entry will be queued again once its file got written
+            logging.debug('%r changed while calculating its checksum', uid)
+        elif error is not None:
+            logging.error('Error calculating the checksum of %r: %r', uid,
+                          error)
         else:
-            return True
+            (checksum, legacy_checksum), candidate_checksums = result
+            # entries of the same size that were never hashed, since their
+            # size used to be unique
+            for candidate_uid, checksums in candidate_checksums.items():
+                if candidate_uid in self._changed_uids or \
+                        not self._checksum_store.is_unhashed(candidate_uid):
+                    continue
+                self._add_to_group(candidate_uid, *checksums)
+
+            if checksum is not None:
+                self._add_to_group(uid, checksum, legacy_checksum)
+            else:
+                self._checksum_store.add(uid, None)
+        self._queue.remove(uid)
+
+    def _update_stats(self, processed):
+        self._processed += processed
+        elapsed = time.time() - self._batch_start
+        if processed and elapsed > 0:
+            self._drain_rate = processed / elapsed
 
-    def _calculate_md5sum(self, path):
-        """Calculate the md5 checksum of a given file.
+    def _add_to_group(self, uid, checksum, legacy_checksum):
+        """Record the checksum of an entry and, if an identical file is
+           already known, substitute its file with a hard link to that
+           pre-existing file.
 
         """
-        popen = subprocess.Popen(['md5sum', path], stdout=subprocess.PIPE)
-        stdout, __ = popen.communicate()
-        return str(stdout).split(' ', 1)[0]
+        if legacy_checksum is not None and \
+                self._checksum_store.get_uids(legacy_checksum):
+            self._convert_legacy_checksum(legacy_checksum, checksum)
+        self._metadata_store.set_property(uid, 'checksum', checksum)
+
+        if self._checksum_store.get_checksum(uid) == checksum:
+            # already linked
+            return
+
+        for existing_uid in self._checksum_store.get_uids(checksum):
+            if os.path.exists(self._file_store.get_file_path(existing_uid)):
+                self._file_store.hard_link_entry(uid, existing_uid)
+                break
+        self._checksum_store.add(uid, checksum)
@@ -0,0 +1,147 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import os
+import struct
+import zlib
+
+from gi.repository import GObject
+
+_MAGIC = 'CQS1'
+
+# Magic, generation and clean flag, followed by a CRC32 of them
+_HEADER_FORMAT = '>4sQB'
+_CHECKSUM_FORMAT = '>I'
+
+# Seconds without changes after which the data store gets marked clean
+_CLEAN_DELAY = 5
+
+
+class StateFile(object):
+    """Record whether the data store got changed since it was last known
+    to be consistent.
+
+    The state is a generation number, incremented each time the data store
+    gets changed after having been marked clean, and a clean flag, kept in
+    a small file overwritten in place. Marking the data store clean is
+    deferred until it went unchanged for a few seconds, so that a burst of
+    changes only costs a write and fsync() when it starts and when it ends.
+    The dirty state gets synced before any change is made, so that it
+    can't be lost while journaled changes survive a crash.
+    """
+
+    def __init__(self, path, clean_delay=_CLEAN_DELAY):
+        self._path = path
+        self._clean_delay = clean_delay
+        self._fd = None
+        self._clean_id = None
+        # state found on disk, clean being None if there is no state file
+        self.generation, self.clean = self._read()
+        self._written_clean = self.clean
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return 0, None
+
+        f = open(self._path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        header_size = struct.calcsize(_HEADER_FORMAT)
+        size = header_size + struct.calcsize(_CHECKSUM_FORMAT)
+        try:
+            magic, generation, clean = struct.unpack(_HEADER_FORMAT,
+                                                     data[:header_size])
+            checksum, = struct.unpack(_CHECKSUM_FORMAT,
+                                      data[header_size:size])
+        except struct.error:
+            magic = None
+        if magic != _MAGIC or checksum != _checksum(data[:header_size]):
+            logging.warning('Damaged state file %s', self._path)
+            return 0, False
+        return generation, bool(clean)
+
+    def mark_dirty(self):
+        if self._clean_id is not None:
+            # the file still says the data store is dirty
+            GObject.source_remove(self._clean_id)
+            self._clean_id = None
+            return
+        if self._written_clean is False:
+            return
+
+        self.generation += 1
+        try:
+            self._write(False)
+            os.fdatasync(self._fd)
+        except (IOError, OSError):
+            logging.exception('Could not mark the datastore dirty')
+
+    def mark_clean(self):
+        if self._written_clean or self._clean_id is not None:
+            return
+        self._clean_id = GObject.timeout_add_seconds(self._clean_delay,
+                                                     self._clean_cb)
+
+    def _clean_cb(self):
+        self._clean_id = None
+        self._write_clean()
+        return False
+
+    def _write_clean(self):
+        try:
+            self._write(True)
+            os.fdatasync(self._fd)
+        except (IOError, OSError):
+            logging.exception('Could not mark the datastore clean')
+
+    def _write(self, clean):
+        header = struct.pack(_HEADER_FORMAT, _MAGIC, self.generation,
+                             int(clean))
+        data = header + struct.pack(_CHECKSUM_FORMAT, _checksum(header))
+        if self._fd is None:
+            created = not os.path.exists(self._path)
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT, 0644)
+            if created:
+                _sync_dir(os.path.dirname(self._path))
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, data)
+        self._written_clean = clean
+
+    def close(self):
+        """Write the clean state right away if it is pending."""
+        if self._clean_id is not None:
+            GObject.source_remove(self._clean_id)
+            self._clean_id = None
+            self._write_clean()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
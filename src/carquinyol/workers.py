@@ -0,0 +1,74 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import Queue
+import threading
+
+from gi.repository import GObject
+
+
+class WorkerPool(object):
+    """Run functions on a fixed set of threads.
+
+    The result of each function is handed to its callback in the main loop,
+    so callbacks don't need to care about threads.
+    """
+
+    def __init__(self, size, name='worker'):
+        GObject.threads_init()
+        self._queue = Queue.Queue()
+        self._size = size
+        for i in range(size):
+            thread = threading.Thread(target=self._run,
+                                      name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Stop the threads once the functions already submitted are done.
+        """
+        for __ in range(self._size):
+            self._queue.put(None)
+
+    def submit(self, func, args=(), callback=None):
+        """Call func(*args) on a worker thread.
+
+        callback(result, exc) gets called from the main loop once func
+        finishes, with exc set to the exception raised by func, if any.
+        """
+        self._queue.put((func, args, callback))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            func, args, callback = job
+            result = None
+            exc = None
+            try:
+                result = func(*args)
+            except Exception, exc:
+                logging.exception('Error in worker calling %r', func)
+
+            if callback is not None:
+                GObject.idle_add(self._complete, callback, result, exc)
+
+    def _complete(self, callback, result, exc):
+        callback(result, exc)
+        return False
@@ -0,0 +1,192 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Tests for the bulk create_many(), update_many() and delete_many()
+calls of the data store.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from carquinyol import datastore
+from carquinyol import layoutmanager
+from carquinyol.filestore import FileStore
+from carquinyol.metadatastore import MetadataStore
+
+
+class _FakeIndexStore(object):
+
+    def __init__(self):
+        self.batch_depth = 0
+        self.batches = 0
+        self.epoch = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def begin_batch(self):
+        self.batch_depth += 1
+
+    def end_batch(self):
+        self.batch_depth -= 1
+        self.batches += 1
+
+    def begin_change(self, uid):
+        pass
+
+    def store(self, uid, properties):
+        pass
+
+    def delete(self, uid):
+        pass
+
+
+class _FakeOptimizer(object):
+
+    def optimize(self, uid):
+        pass
+
+    def remove(self, uid):
+        pass
+
+
+class _FakeStateFile(object):
+
+    def __init__(self):
+        self.generation = 0
+        self.clean = True
+
+    def mark_dirty(self):
+        if self.clean:
+            self.generation += 1
+        self.clean = False
+
+    def mark_clean(self):
+        self.clean = True
+
+
+class BulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self._root_path = tempfile.mkdtemp()
+        layout_manager = object.__new__(layoutmanager.LayoutManager)
+        layout_manager._root_path = self._root_path
+        layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
+        layoutmanager._instance = layout_manager
+
+        self._data_store = object.__new__(datastore.DataStore)
+        self._data_store._index_store = _FakeIndexStore()
+        self._data_store._metadata_store = MetadataStore()
+        self._data_store._file_store = FileStore()
+        self._data_store._optimizer = _FakeOptimizer()
+        self._data_store._state = _FakeStateFile()
+        self._data_store._index_updating = False
+        for signal in ['Created', 'Updated', 'Deleted', 'Progress']:
+            setattr(self._data_store, signal, lambda *args: None)
+
+    def tearDown(self):
+        layoutmanager._instance = None
+        shutil.rmtree(self._root_path)
+
+    def _make_file(self, data):
+        fd, path = tempfile.mkstemp(dir=self._root_path)
+        os.write(fd, data)
+        os.close(fd)
+        return path
+
+    def _create_many(self, entries):
+        results = []
+        self._data_store.create_many(entries, results.append, None)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def _update_many(self, entries):
+        results = []
+        self._data_store.update_many(entries, results.append, None)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def test_create_many_empty(self):
+        self.assertEqual(self._create_many([]), [])
+        self.assertTrue(self._data_store._state.clean)
+        self.assertEqual(self._data_store._index_store.batches, 0)
+
+    def test_update_many_empty(self):
+        self.assertEqual(self._update_many([]), [])
+        self.assertTrue(self._data_store._state.clean)
+        self.assertEqual(self._data_store._index_store.batches, 0)
+
+    def test_create_many(self):
+        file_path = self._make_file('data')
+        results = self._create_many([
+            ({'title': 'one'}, file_path, True),
+            ({'title': 'two'}, '', False),
+        ])
+
+        self.assertEqual([error for uid, error in results], ['', ''])
+        uid = results[0][0]
+        data_path = layoutmanager.get_instance().get_data_path(uid)
+        self.assertEqual(open(data_path).read(), 'data')
+        self.assertTrue(self._data_store._state.clean)
+        self.assertEqual(self._data_store._index_store.batches, 1)
+        self.assertEqual(self._data_store._index_store.batch_depth, 0)
+
+    def test_create_many_errors(self):
+        missing_path = os.path.join(self._root_path, 'missing')
+        results = self._create_many([
+            ({'title': 'one'}, '', False),
+            ({'title': 'two'}, missing_path, False),
+        ])
+
+        self.assertNotEqual(results[0][0], '')
+        self.assertEqual(results[0][1], '')
+        self.assertEqual(results[1][0], '')
+        self.assertTrue(results[1][1].startswith('ValueError: '))
+        # a failed entry is left to the recovery at the next start
+        self.assertFalse(self._data_store._state.clean)
+        self.assertEqual(self._data_store._index_store.batch_depth, 0)
+
+    def test_update_many_errors(self):
+        uid = self._create_many([({'title': 'one'}, '', False)])[0][0]
+        missing_path = os.path.join(self._root_path, 'missing')
+        errors = self._update_many([
+            (uid, {'title': 'two'}, '', False),
+            (uid, {'title': 'three'}, missing_path, False),
+        ])
+
+        self.assertEqual(errors[0], '')
+        self.assertTrue(errors[1].startswith('ValueError: '))
+        # the failed update left the entry as the first one made it
+        metadata = self._data_store._metadata_store.retrieve(uid)
+        self.assertEqual(metadata['title'], 'two')
+        self.assertFalse(self._data_store._state.clean)
+        self.assertEqual(self._data_store._index_store.batch_depth, 0)
+
+    def test_delete_many_errors(self):
+        uid = self._create_many([({'title': 'one'}, '', False)])[0][0]
+        errors = self._data_store.delete_many([uid, uid])
+
+        self.assertEqual(errors[0], '')
+        self.assertNotEqual(errors[1], '')
+        self.assertFalse(os.path.exists(
+            layoutmanager.get_instance().get_entry_path(uid)))
+        self.assertFalse(self._data_store._state.clean)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Tests for querying the index of the data store."""
+
+import shutil
+import tempfile
+import unittest
+
+from carquinyol import layoutmanager
+from carquinyol.indexstore import IndexStore
+
+_UID = '0a1b2c3d-0000-0000-0000-000000000000'
+
+
+class IndexStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._root_path = tempfile.mkdtemp()
+        layout_manager = object.__new__(layoutmanager.LayoutManager)
+        layout_manager._root_path = self._root_path
+        layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
+        layoutmanager._instance = layout_manager
+
+        self._index_store = IndexStore()
+        self._index_store.open_index()
+
+    def tearDown(self):
+        self._index_store.close_index()
+        layoutmanager._instance = None
+        shutil.rmtree(self._root_path)
+
+    def _store_entry(self):
+        self._index_store.store(_UID, {'title': 'Drawing', 'timestamp': 1,
+                                       'creation_time': 1,
+                                       'activity': 'org.laptop.Paint'})
+        self._index_store.flush()
+
+    def test_find_after_open(self):
+        self.assertEqual(self._index_store.find({}), ([], 0))
+
+    def test_find_after_reopen(self):
+        self._store_entry()
+        self._index_store.close_index()
+        self._index_store.open_index()
+
+        self.assertEqual(self._index_store.find({}), ([_UID], 1))
+        self.assertEqual(
+            self._index_store.find({'activity': 'org.laptop.Paint'})[0],
+            [_UID])
+
+    def test_query_string_after_reopen(self):
+        self._store_entry()
+        self._index_store.close_index()
+        self._index_store.open_index()
+
+        self.assertEqual(self._index_store.find({'query': 'drawing'})[0],
+                         [_UID])
+
+
+if __name__ == '__main__':
+    unittest.main()